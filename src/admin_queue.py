@@ -0,0 +1,192 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import telegram
+
+import db
+
+
+
+class AdminForumQueue:
+  """
+    관리자 포럼으로 보내는 메시지를 백그라운드에서 처리하는 큐
+    - 유저 채팅 처리 경로에서는 큐에 넣기만 하고 바로 반환 (관리자 그룹 상태와 무관하게 응답)
+    - batch_interval 동안 모인 메시지를 토픽별로 묶어서 전송 (연속된 forward는 forward_messages 한 번으로)
+    - 관리자 그룹으로의 API 호출 간격을 min_send_interval 이상으로 유지
+    - 처음 보는 유저의 포럼 토픽은 워커가 비동기로 생성
+  """
+  def __init__(
+    self,
+    admin_chat_id: Optional[int] = None,
+    batch_interval: float = 0.5,  # 메시지를 모으는 시간(초)
+    min_send_interval: float = 1.0,  # 관리자 그룹 API 호출 최소 간격(초)
+    max_queue_size: int = 10000,  # 큐 최대 크기, 넘치면 버림
+    max_text_length: int = 4096,  # 텔레그램 메시지 최대 길이
+    max_forward_batch: int = 100,  # forward_messages 한 번에 보낼 수 있는 최대 메시지 수
+    max_retries: int = 3,  # 네트워크 오류 시 재시도 횟수
+    retry_backoff: float = 2.0,  # 재시도 대기 시간(초), 시도마다 2배
+  ):
+    self.admin_chat_id = admin_chat_id
+    self.batch_interval = batch_interval
+    self.min_send_interval = min_send_interval
+    self.max_text_length = max_text_length
+    self.max_forward_batch = max_forward_batch
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+    self.last_send_time = 0.0
+    self.bot: Optional[telegram.Bot] = None
+    self._worker: Optional[asyncio.Task] = None
+
+  def start(self, bot: telegram.Bot) -> None:
+    self.bot = bot
+    if self.admin_chat_id is None:
+      self.admin_chat_id = int(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID'))
+    if self._worker is None or self._worker.done():
+      self._worker = asyncio.create_task(self._run())
+
+  async def stop(self, timeout: float = 10.0) -> None:
+    # 남은 메시지를 최대 timeout 동안 보내고 종료
+    if self._worker is None:
+      return
+    try:
+      await asyncio.wait_for(self.queue.join(), timeout)
+    except asyncio.TimeoutError:
+      print('관리자 큐 종료 시간 초과 (남은 메시지: {})'.format(self.queue.qsize()))
+    self._worker.cancel()
+    try:
+      await self._worker
+    except asyncio.CancelledError:
+      pass
+    self._worker = None
+
+  def _put(self, item: Dict[str, Any]) -> None:
+    try:
+      self.queue.put_nowait(item)
+    except asyncio.QueueFull:
+      print('관리자 큐가 가득 차서 메시지를 버립니다: {}'.format(item))
+
+  def enqueue_forward(self, user_id: int, user_name: str, message_id: int) -> None:
+    # 유저 채팅방의 메시지를 해당 유저의 포럼 토픽으로 전달
+    self._put({
+      'kind': 'forward',
+      'user_id': user_id,
+      'user_name': user_name,
+      'message_ids': [message_id],
+    })
+
+  def enqueue_text(self, user_id: int, user_name: str, text: str) -> None:
+    # 유저의 포럼 토픽에 텍스트 메시지 전송
+    self._put({
+      'kind': 'text',
+      'user_id': user_id,
+      'user_name': user_name,
+      'text': text,
+    })
+
+  async def _run(self) -> None:
+    while True:
+      first = await self.queue.get()
+      # batch_interval 동안 메시지를 더 모음
+      await asyncio.sleep(self.batch_interval)
+      items = [first]
+      while not self.queue.empty():
+        items.append(self.queue.get_nowait())
+
+      try:
+        for user_id, user_items in self._group_by_user(items).items():
+          try:
+            await self._send_user_batch(user_id, user_items)
+          except Exception as e:
+            print('관리자 포럼 전송 중 오류 발생 (user_id: {}): {}'.format(user_id, e))
+      finally:
+        for _ in items:
+          self.queue.task_done()
+
+  def _group_by_user(self, items: List[Dict[str, Any]]) -> Dict[int, List[Dict[str, Any]]]:
+    # 유저별로 묶고, 같은 종류의 연속된 메시지는 하나로 합침 (유저별 순서는 유지)
+    groups: Dict[int, List[Dict[str, Any]]] = {}
+    for item in items:
+      user_items = groups.setdefault(item['user_id'], [])
+      last = user_items[-1] if user_items else None
+      if last is not None and last['kind'] == item['kind'] == 'forward' \
+        and len(last['message_ids']) + len(item['message_ids']) <= self.max_forward_batch:
+        last['message_ids'] = last['message_ids'] + item['message_ids']
+      elif last is not None and last['kind'] == item['kind'] == 'text' \
+        and len(last['text']) + 2 + len(item['text']) <= self.max_text_length:
+        last['text'] = last['text'] + '\n\n' + item['text']
+      else:
+        user_items.append(dict(item))
+    return groups
+
+  async def _get_forum_id(self, user_id: int, user_name: str) -> int:
+    room_info = db.room_info.get_row_from_user_id(user_id)
+    if room_info is not None:
+      return room_info['admin_forum_id']
+    # 새 유저면 포럼 토픽 생성
+    new_room = await self._call(
+      self.bot.create_forum_topic,
+      chat_id=self.admin_chat_id,
+      name=user_name or str(user_id),
+    )
+    forum_id = new_room.message_thread_id
+    db.room_info.insert_row(user_id, forum_id)
+    return forum_id
+
+  async def _send_user_batch(self, user_id: int, user_items: List[Dict[str, Any]]) -> None:
+    forum_id = await self._get_forum_id(user_id, user_items[0]['user_name'])
+    for item in user_items:
+      # 하나가 실패해도 나머지 메시지는 계속 전송
+      try:
+        if item['kind'] == 'forward':
+          await self._call(
+            self.bot.forward_messages,
+            chat_id=self.admin_chat_id,
+            from_chat_id=user_id,
+            message_ids=item['message_ids'],
+            message_thread_id=forum_id,
+          )
+        elif item['kind'] == 'text':
+          await self._call(
+            self.bot.send_message,
+            chat_id=self.admin_chat_id,
+            message_thread_id=forum_id,
+            text=item['text'],
+          )
+      except Exception as e:
+        print('관리자 포럼 전송 중 오류 발생 (user_id: {}, kind: {}): {}'.format(user_id, item['kind'], e))
+
+  async def _call(self, method, **kwargs):
+    """
+      관리자 그룹 API 호출
+      - 호출 간격을 min_send_interval 이상으로 유지
+      - Rate limit(RetryAfter)은 요청한 시간만큼 기다린 후 재시도
+      - 일시적인 네트워크 오류(NetworkError, TimedOut)는 max_retries 만큼 지수 백오프로 재시도
+    """
+    retry_count = 0
+    while True:
+      time_since_last_send = time.time() - self.last_send_time
+      if time_since_last_send < self.min_send_interval:
+        await asyncio.sleep(self.min_send_interval - time_since_last_send)
+      self.last_send_time = time.time()
+      try:
+        return await method(**kwargs)
+      except telegram.error.RetryAfter as e:
+        retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+        await asyncio.sleep(retry_after)
+      except telegram.error.BadRequest:
+        # BadRequest도 NetworkError의 하위 클래스지만 재시도해도 실패함
+        raise
+      except telegram.error.NetworkError as e:
+        if retry_count >= self.max_retries:
+          raise
+        retry_count += 1
+        print('관리자 포럼 전송 재시도 ({} / {}): {}'.format(retry_count, self.max_retries, e))
+        await asyncio.sleep(self.retry_backoff * (2 ** (retry_count - 1)))
+
+
+
+# Singletons
+admin_queue = AdminForumQueue()
@@ -1,19 +1,32 @@
 import asyncio
+import html
+import io
 import logging
 import os
 import time
-from collections import deque
+import weakref
+from collections import OrderedDict, deque
 from typing import Optional
 
 import dotenv
 import telegram
-from telegram.ext import ContextTypes
+from telegram.ext import Application, ContextTypes
 
+import admin_queue
+import diagnostics
 import lm
 import db
+import media
 
 dotenv.load_dotenv()
 
+# 언어모델 백엔드 장애 시 유저에게 보내는 안내 메시지
+LM_UNAVAILABLE_MESSAGE = '현재 AI 상담 답변이 일시적으로 어렵습니다. 상담사가 확인 후 답변드리겠습니다.'
+# 사진을 다운로드/처리하지 못했을 때 유저에게 보내는 안내 메시지
+IMAGE_UNAVAILABLE_MESSAGE = '보내주신 사진을 처리하지 못했습니다. 상담사가 확인 후 답변드리겠습니다.'
+# 캡션 없이 사진만 보냈을 때 비전 모델에 함께 보내는 요청
+IMAGE_DEFAULT_PROMPT = '이 사진을 보고 상담해주세요.'
+
 
 
 class ThrottledTelegramChat:
@@ -26,10 +39,11 @@ class ThrottledTelegramChat:
     self.batch_size = batch_size
     self.message_buffer = deque()
     self.last_update_time = 0
+    self.chunk_count = 0  # 진단용: 지금까지 받은 청크 수
 
   async def process_stream(
     self,
-    chat_stream,
+    chat_stream: lm.ThreadedStream,
     update: telegram.Update,
     context: ContextTypes.DEFAULT_TYPE,
     initial_message: Optional[str] = None,
@@ -62,7 +76,7 @@ class ThrottledTelegramChat:
         print(f"메시지 업데이트 중 오류 발생: {e}")
 
     try:
-      for chunk in chat_stream:
+      async for chunk in chat_stream:
         if chunk:
           # escape  '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!' 
           # chunk = chunk.replace('_', '\\_').replace('**', '*').replace('[', '\\[').replace(']', '\\]')\
@@ -72,6 +86,7 @@ class ThrottledTelegramChat:
           #   .replace('.', '\\.').replace('!', '\\!')
           current_text += chunk
           self.message_buffer.append(chunk)
+          self.chunk_count += 1
 
           # 버퍼가 batch_size를 넘거나, 마지막 업데이트로부터 min_update_interval이 지난 경우
           current_time = time.time()
@@ -91,8 +106,24 @@ class ThrottledTelegramChat:
       # 스트림이 종료된 후 최종 업데이트
       if self.message_buffer:
         await update_message()
-        return current_text
+      return current_text
 
+    except lm.LmUnavailableError as e:
+      print(f"언어모델 백엔드 오류: {e}")
+      # 받은 답변이 있으면 부분 답변으로 마무리
+      if current_text:
+        await update_message()
+        return current_text
+      # 받은 답변이 없으면 안내 메시지로 교체
+      try:
+        await context.bot.edit_message_text(
+          chat_id=update.effective_chat.id,
+          message_id=message.message_id,
+          text=LM_UNAVAILABLE_MESSAGE,
+        )
+      except Exception as e:
+        print(f"메시지 업데이트 중 오류 발생: {e}")
+      raise
     except Exception as e:
       print(f"스트리밍 처리 중 오류 발생: {e}")
       # 오류 발생 시 최종 상태 업데이트
@@ -106,7 +137,63 @@ logging.basicConfig(
   level=logging.INFO
 )
 
-lm_instance = lm.VpsbLmServer2()
+# GPU 서버 장애/포화 시 사용할 CPU 언어모델 (CPU_FALLBACK_MODEL_PATH에 GGUF 파일이 있을 때만)
+cpu_lm_instance = None
+if os.environ.get('CPU_FALLBACK_MODEL_PATH'):
+  cpu_lm_instance = lm.VpsbLmCpuServer(
+    model_path=os.environ.get('CPU_FALLBACK_MODEL_PATH'),
+    num_workers=int(os.environ.get('CPU_FALLBACK_WORKERS', 1)),
+    max_pending=int(os.environ['CPU_FALLBACK_MAX_PENDING']) if os.environ.get('CPU_FALLBACK_MAX_PENDING') else None,
+  )
+lm_instance = lm.VpsbLmServer2(
+  fallback=cpu_lm_instance,
+  max_in_flight=int(os.environ['LM_MAX_IN_FLIGHT']) if os.environ.get('LM_MAX_IN_FLIGHT') else None,
+)
+# 이미지 답변용 비전 언어모델 (VISION_LM_BASE_URL이 있을 때만, OpenAI 호환 서버)
+vision_lm_instance = None
+if os.environ.get('VISION_LM_BASE_URL'):
+  vision_lm_instance = lm.VpsbLmServer2(
+    base_url=os.environ.get('VISION_LM_BASE_URL'),
+    model_name=os.environ.get('VISION_LM_MODEL', 'Qwen/Qwen2-VL-7B-Instruct-AWQ'),
+  )
+
+async def rotate_room_chats(interval: float = 24 * 60 * 60):
+  # 보관 기간이 지난 대화를 주기적으로 월별 아카이브 DB로 이동
+  while True:
+    try:
+      # 작은 묶음으로 나눠서 옮기고 묶음 사이에 다른 업데이트를 처리
+      moved = {}
+      for month, count in db.room_chats.iter_rotate_partitions(int(os.environ.get('ROOM_CHATS_RETENTION_DAYS', 90))):
+        moved[month] = moved.get(month, 0) + count
+        await asyncio.sleep(0)
+      for month, count in moved.items():
+        print(f"대화 {count}개를 아카이브로 이동했습니다 ({month})")
+    except Exception as e:
+      print(f"대화 아카이브 중 오류 발생: {e}")
+    await asyncio.sleep(interval)
+
+background_tasks = set()
+
+def run_in_background(coro) -> asyncio.Task:
+  # 결과를 기다리지 않는 작업 (종료 시 post_shutdown에서 취소)
+  task = asyncio.create_task(coro)
+  background_tasks.add(task)
+  task.add_done_callback(background_tasks.discard)
+  return task
+
+async def post_init(application: Application):
+  if cpu_lm_instance is not None:
+    cpu_lm_instance.start()
+  admin_queue.admin_queue.start(application.bot)
+  run_in_background(rotate_room_chats())
+
+async def post_shutdown(application: Application):
+  for task in list(background_tasks):
+    task.cancel()
+  await admin_queue.admin_queue.stop()
+  if cpu_lm_instance is not None:
+    cpu_lm_instance.close()
+  media.media_pipeline.close()
 
 async def start(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
   # await context.bot.send_message(chat_id=update.effective_chat.id, text="I'm a bot, please talk to me!")
@@ -131,7 +218,7 @@ async def admin_group_chat(update: telegram.Update, context: ContextTypes.DEFAUL
   if update.message.message_thread_id:
     # 유저 채널로 메시지 포워딩
     room_info = db.room_info.get_row_from_admin_forum_id(update.message.message_thread_id)
-    if room_info.get('user_id'):
+    if room_info is not None and room_info.get('user_id'):
       await update.message.forward(
         chat_id=room_info.get('user_id'),
         protect_content=False
@@ -141,10 +228,12 @@ async def admin_group_chat(update: telegram.Update, context: ContextTypes.DEFAUL
       #   text=update.message.text
       # )
     else:
-      update.message.reply_text('유저 정보를 찾을 수 없습니다.')
+      await update.message.reply_text('유저 정보를 찾을 수 없습니다.')
   else:
     if db.prompt_update_state:
       lm_instance.system_message = update.message.text
+      if vision_lm_instance is not None:
+        vision_lm_instance.system_message = lm_instance.system_message
       config = db.config.load_config()
       config.update({'system_prompt': lm_instance.system_message})
       db.config.save_config(config)
@@ -162,16 +251,194 @@ async def admin_group_chat(update: telegram.Update, context: ContextTypes.DEFAUL
           [telegram.InlineKeyboardButton('AI 답변 시작', callback_data='start_ai_chat'), telegram.InlineKeyboardButton('AI 답변 중지', callback_data='stop_ai_chat')],
           [telegram.InlineKeyboardButton('현재 프롬프트 확인', callback_data='get_prompt')],
           [telegram.InlineKeyboardButton('프롬프트 변경', callback_data='change_prompt')],
+          [telegram.InlineKeyboardButton('진단 정보', callback_data='diagnostics'), telegram.InlineKeyboardButton('프로파일 (10초)', callback_data='profile')],
         ])
       )
 
+# 검색어 보관 (callback_data는 64바이트 제한이 있어 검색어 대신 id를 사용)
+SEARCH_PAGE_SIZE = 10
+search_queries = OrderedDict()
+search_query_next_id = 0
+
+def build_search_page(query_id: int, page: int):
+  query = search_queries[query_id]
+  # 다음 페이지가 있는지 알기 위해 하나 더 가져옴
+  rows = db.room_chats_fts.search(
+    query,
+    limit=SEARCH_PAGE_SIZE + 1,
+    offset=page * SEARCH_PAGE_SIZE,
+    highlight=('\x02', '\x03'),
+  )
+  has_next = len(rows) > SEARCH_PAGE_SIZE
+  rows = rows[:SEARCH_PAGE_SIZE]
+
+  # 포럼 토픽 링크: https://t.me/c/{-100을 뺀 그룹 id}/{토픽 id}
+  admin_chat_id = str(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID')).removeprefix('-100')
+  lines = ['🔍 <b>{}</b> 검색 결과 ({} 페이지)'.format(html.escape(query), page + 1)]
+  if not rows:
+    lines.append('검색 결과가 없습니다.')
+  for index, row in enumerate(rows):
+    room_info = db.room_info.get_row_from_user_id(row['user_id'])
+    patient = '환자 {}'.format(row['user_id'])
+    if room_info is not None:
+      patient = '<a href="https://t.me/c/{}/{}">{}</a>'.format(admin_chat_id, room_info['admin_forum_id'], patient)
+    snippet = html.escape(row['snippet'] or '').replace('\x02', '<b>').replace('\x03', '</b>')
+    lines.append('{}. {} {} · {}\n{}'.format(
+      page * SEARCH_PAGE_SIZE + index + 1,
+      '👤' if row['sender'] == 'user' else '🤖',
+      patient,
+      html.escape(str(row['date'] or '')[:10]),
+      snippet,
+    ))
+
+  buttons = []
+  if page > 0:
+    buttons.append(telegram.InlineKeyboardButton('◀ 이전', callback_data='search:{}:{}'.format(query_id, page - 1)))
+  if has_next:
+    buttons.append(telegram.InlineKeyboardButton('다음 ▶', callback_data='search:{}:{}'.format(query_id, page + 1)))
+  reply_markup = telegram.InlineKeyboardMarkup([buttons]) if buttons else None
+  return '\n\n'.join(lines), reply_markup
+
+async def admin_search(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
+  global search_query_next_id
+  if update.effective_chat.id != int(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID')):
+    return
+  query = ' '.join(context.args or [])
+  if not query:
+    await update.message.reply_text('사용법: /search 검색어 (예: /search 코 성형)')
+    return
+
+  query_id = search_query_next_id
+  search_query_next_id += 1
+  search_queries[query_id] = query
+  # 오래된 검색어 정리
+  while len(search_queries) > 100:
+    search_queries.popitem(last=False)
+
+  text, reply_markup = build_search_page(query_id, 0)
+  await update.message.reply_text(
+    text,
+    parse_mode=telegram.constants.ParseMode.HTML,
+    reply_markup=reply_markup,
+    disable_web_page_preview=True,
+  )
+
+# 진단용: 생성 중인 답변 (key: (유저 id, 유저 메시지 id))
+in_flight_generations = {}
+
+def collect_diagnostics() -> dict:
+  now = time.monotonic()
+  generations = ['count: {}'.format(len(in_flight_generations))]
+  for generation in sorted(in_flight_generations.values(), key=lambda generation: generation['started']):
+    generations.append('  user_id={} age={:.1f}s chunks={}'.format(
+      generation['user_id'],
+      now - generation['started'],
+      generation['throttled_chat'].chunk_count,
+    ))
+
+  breaker = lm_instance.circuit_breaker
+  backend = [
+    'circuit: {} (failures: {})'.format(breaker.state, breaker.failure_count),
+    'in_flight: {} (max: {})'.format(lm_instance.in_flight, lm_instance.max_in_flight),
+  ]
+  if cpu_lm_instance is not None:
+    backend.append('cpu fallback: ready workers {}/{} pending {}'.format(
+      cpu_lm_instance.ready_workers,
+      cpu_lm_instance.num_workers,
+      cpu_lm_instance.pending_requests(),
+    ))
+
+  queues = diagnostics.task_summary()
+  queues.append('admin_queue: {} / {}'.format(admin_queue.admin_queue.queue.qsize(), admin_queue.admin_queue.queue.maxsize))
+
+  db_locks = ['{}: {}'.format(table_name, stats) for table_name, stats in db.lock_wait_stats.items()] or ['no lock waits']
+
+  memory = diagnostics.memory_summary({
+    'room_info mapping': len(db.room_info._user_to_forum),
+    'room_chats archive user map': len(db.room_chats._archive_user_months or {}),
+    'room_chats archive connections': len(db.room_chats._partition_conns),
+    'search_queries': len(search_queries),
+    'in_flight_generations': len(in_flight_generations),
+    'admin_queue': admin_queue.admin_queue.queue.qsize(),
+    'media cache (bytes)': media.media_pipeline.cache_bytes,
+    'media cache (images)': len(media.media_pipeline.cache),
+  })
+
+  return {
+    'in-flight generations': generations,
+    'lm backend': backend,
+    'asyncio tasks / queues': queues,
+    'db lock waits': db_locks,
+    'memory': memory,
+    'threads': diagnostics.thread_stacks(),
+  }
+
+async def send_diagnostics(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_thread_id: Optional[int], profile_seconds: float = 0):
+  # 진단 결과를 파일로 전송, 프로파일은 백그라운드에서 수집 후 따로 전송 (수집하는 동안 다른 업데이트 처리)
+  report = diagnostics.build_report(collect_diagnostics())
+  await context.bot.send_document(
+    chat_id=chat_id,
+    message_thread_id=message_thread_id,
+    document=io.BytesIO(report.encode('utf-8')),
+    filename='diagnostics_{}.txt'.format(time.strftime('%Y%m%d_%H%M%S')),
+  )
+  if profile_seconds > 0:
+    run_in_background(send_profile(context, chat_id, message_thread_id, profile_seconds))
+
+profile_running = False
+
+async def send_profile(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_thread_id: Optional[int], profile_seconds: float):
+  # 이벤트 루프 프로파일 (별도 스레드에서 샘플링, 한 번에 하나만)
+  global profile_running
+  if profile_running:
+    await context.bot.send_message(chat_id=chat_id, message_thread_id=message_thread_id, text='이미 프로파일을 수집 중입니다.')
+    return
+  profile_running = True
+  try:
+    file_time = time.strftime('%Y%m%d_%H%M%S')
+    samples = await diagnostics.profile_event_loop(profile_seconds)
+    await context.bot.send_document(
+      chat_id=chat_id,
+      message_thread_id=message_thread_id,
+      document=io.BytesIO(diagnostics.format_profile(samples).encode('utf-8')),
+      filename='profile_{}.txt'.format(file_time),
+      caption='이벤트 루프 프로파일 ({}초)'.format(profile_seconds),
+    )
+  except Exception as e:
+    print(f"프로파일 전송 중 오류 발생: {e}")
+  finally:
+    profile_running = False
+
+async def admin_diagnostics(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
+  # /diag [프로파일 초]
+  if update.effective_chat.id != int(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID')):
+    return
+  try:
+    profile_seconds = min(float(context.args[0]), 60) if context.args else 0
+  except ValueError:
+    await update.message.reply_text('사용법: /diag [프로파일 초]')
+    return
+  await send_diagnostics(context, update.effective_chat.id, update.message.message_thread_id, profile_seconds)
+
 async def admin_callback(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
   if update.callback_query == None:
     return
 
   data = update.callback_query.data
   
-  if data == 'get_is_ai_chat':
+  if data.startswith('search:'):
+    _, query_id, page = data.split(':')
+    if int(query_id) not in search_queries:
+      await update.callback_query.answer('검색이 만료되었습니다. 다시 검색해주세요.')
+      return
+    text, reply_markup = build_search_page(int(query_id), int(page))
+    await update.callback_query.edit_message_text(
+      text,
+      parse_mode=telegram.constants.ParseMode.HTML,
+      reply_markup=reply_markup,
+      disable_web_page_preview=True,
+    )
+  elif data == 'get_is_ai_chat':
     await update.effective_chat.send_message('AI 답변 상태: ' + ('작동 중' if db.ai_answer_state else '중지'))
   elif data == 'start_ai_chat':
     db.ai_answer_state = True
@@ -181,6 +448,14 @@ async def admin_callback(update: telegram.Update, context: ContextTypes.DEFAULT_
     await update.effective_chat.send_message('AI 답변을 중지합니다.')
   elif data == 'get_prompt':
     await update.effective_chat.send_message('현재 프롬프트: ' + lm_instance.system_message)
+  elif data == 'diagnostics':
+    await update.callback_query.answer()
+    await send_diagnostics(context, update.effective_chat.id, update.effective_message.message_thread_id)
+    return
+  elif data == 'profile':
+    await update.callback_query.answer('10초 동안 프로파일링합니다. 끝나면 파일로 보내드립니다.')
+    await send_diagnostics(context, update.effective_chat.id, update.effective_message.message_thread_id, profile_seconds=10)
+    return
   elif data == 'change_prompt':
     await update.effective_chat.send_message(
       '변경을 원하는 프롬프트를 입력해주세요.'
@@ -188,7 +463,45 @@ async def admin_callback(update: telegram.Update, context: ContextTypes.DEFAULT_
     db.prompt_update_state = True
   await update.callback_query.answer()
 
+def send_typing_action(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
+  # '입력 중...' 표시를 백그라운드로 전송 (응답을 기다리지 않음)
+  async def send():
+    try:
+      await context.bot.send_chat_action(
+        chat_id=update.effective_chat.id,
+        action=telegram.constants.ChatAction.TYPING,
+      )
+    except Exception as e:
+      print(f"입력 중 표시 전송 중 오류 발생: {e}")
+  run_in_background(send())
+
+def notify_lm_unavailable(user_id: int, user_name: str, reason: str = '언어모델 백엔드 장애'):
+  # 관리자 포럼에 장애로 답변하지 못했음을 알림
+  admin_queue.admin_queue.enqueue_text(
+    user_id,
+    user_name,
+    '⚠️ {}로 AI 답변 대신 안내 메시지를 보냈습니다. 직접 답변이 필요합니다.'.format(reason)
+  )
+
+# 유저별 처리 잠금: 업데이트를 동시에 처리해도(concurrent_updates) 같은 유저의 메시지는 도착 순서대로 하나씩 처리
+# - room_chats에 유저 메시지와 답변이 번갈아 기록되고, 다음 메시지의 대화 기록에 이전 답변이 포함됨
+user_locks = weakref.WeakValueDictionary()
+
+def get_user_lock(user_id: int) -> asyncio.Lock:
+  lock = user_locks.get(user_id)
+  if lock is None:
+    lock = asyncio.Lock()
+    user_locks[user_id] = lock
+  return lock
+
 async def chat_single_private(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
+  if update.effective_user == None:
+    print('No effective_user')
+    return
+  async with get_user_lock(update.effective_user.id):
+    await _chat_single_private(update, context)
+
+async def _chat_single_private(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
   if update.effective_chat == None:
     print('No effective_chat')
     return
@@ -205,58 +518,84 @@ async def chat_single_private(update: telegram.Update, context: ContextTypes.DEF
   user_name = update.effective_user.full_name
   date_str = str(update.message.date)
   chat_text = update.message.text
+  caption = update.message.caption
+  image_source = media.get_image_source(update.message)
+  # 이미지는 캡션과 함께 '[사진]'으로 기록
+  saved_text = chat_text
+  if chat_text is None and image_source is not None:
+    saved_text = '[사진] ' + caption if caption else '[사진]'
 
-  # 관리 정보 가져오기
-  room_info = db.room_info.get_row_from_user_id(user_id)
-  # 새 채팅이면
-  if room_info == None:
-    new_room = await context.bot.create_forum_topic(chat_id=int(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID')), name=user_name)
-    forum_id = new_room.message_thread_id
-    db.room_info.insert_row(user_id, forum_id)
-    room_info = {
-      'user_id': user_id,
-      'admin_forum_id': forum_id
-    }
-  
-  # 메시지 관리자에게 전달 및 저장
-  db.room_chats.insert_row(user_id, 'user', chat_text, date_str)
-  await update.message.forward(
-    chat_id=int(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID')),
-    message_thread_id=room_info['admin_forum_id']
-  )
+  # ai 답변이 꺼져 있거나, 텍스트나 (비전 모델이 있을 때) 이미지가 아니면 저장/전달만 함
+  will_answer = db.ai_answer_state and (chat_text or (image_source is not None and vision_lm_instance is not None))
+  if will_answer:
+    send_typing_action(update, context)
+    # 마지막 채팅들 가져오기 (이번 메시지를 저장하기 전에 조회해서 중복되지 않도록, 오래된 순으로)
+    chat_history = db.build_history(list(reversed(db.room_chats.get_last_rows_from_user_id(user_id, 10))))
+
+  # 메시지 저장 및 관리자에게 전달 (포럼 토픽 생성과 전달은 백그라운드 큐에서 처리)
+  # 저장은 답변 생성을 시작하기 전에 끝나므로 room_chats에는 항상 유저 메시지 다음에 답변이 기록됨
+  db.room_chats.insert_row(user_id, 'user', saved_text, date_str)
+  admin_queue.admin_queue.enqueue_forward(user_id, user_name, update.message.message_id)
 
   # *** 챗봇 채팅 생성 프로세스
-  # ai 답변이 꺼져 있으면 무시...
-  if not db.ai_answer_state:
+  if not will_answer:
     return
-  # 텍스트 채팅이 아니면 무시...
-  if not chat_text:
-    return
-  # 마지막 채팅들 가져오기
-  chat_history = db.build_history(db.room_chats.get_last_rows_from_user_id(user_id, 10))
-  chat_history.append({
-    'role': 'user',
-    'content': chat_text,
-  })
+  backend = lm_instance
+  if chat_text:
+    chat_history.append({
+      'role': 'user',
+      'content': chat_text,
+    })
+  else:
+    # 이미지 다운로드 및 전처리 (프로세스 풀)
+    try:
+      jpeg = await media.media_pipeline.get_image(context.bot, *image_source)
+    except Exception as e:
+      print(f"이미지 처리 중 오류 발생: {e}")
+      await update.message.reply_text(IMAGE_UNAVAILABLE_MESSAGE)
+      notify_lm_unavailable(user_id, user_name, '이미지 처리 실패')
+      return
+    chat_history.append({
+      'role': 'user',
+      'content': [
+        {'type': 'text', 'text': caption or IMAGE_DEFAULT_PROMPT},
+        {'type': 'image_url', 'image_url': {'url': media.to_data_url(jpeg)}},
+      ],
+    })
+    backend = vision_lm_instance
   
-  # 스트림 생성 요청
-  chat_stream = lm_instance.chat_stream(chat_history)
+  # 언어모델 백엔드 장애 중이면 바로 안내 메시지 전송
+  if not backend.is_available():
+    await update.message.reply_text(LM_UNAVAILABLE_MESSAGE)
+    notify_lm_unavailable(user_id, user_name)
+    return
+
+  # 스트림 생성 요청 (별도 스레드에서 바로 시작, 초기 메시지 전송과 동시에 진행)
+  chat_stream = lm.ThreadedStream(backend.chat_stream(chat_history)).start()
   throttled_chat = ThrottledTelegramChat(
     min_update_interval=1.0,  # 1초마다 업데이트
     batch_size=20,  # 20개의 토큰이 모이면 업데이트
   )
-  assistant_message = await throttled_chat.process_stream(
-    chat_stream,
-    update,
-    context,
-    initial_message="..."
-  )
+  in_flight_generations[(user_id, update.message.message_id)] = {
+    'user_id': user_id,
+    'started': time.monotonic(),
+    'throttled_chat': throttled_chat,
+  }
+  try:
+    assistant_message = await throttled_chat.process_stream(
+      chat_stream,
+      update,
+      context,
+      initial_message="..."
+    )
+  except lm.LmUnavailableError:
+    notify_lm_unavailable(user_id, user_name)
+    return
+  finally:
+    chat_stream.close()
+    in_flight_generations.pop((user_id, update.message.message_id), None)
 
   # *** 채팅 기록 저장
   db.room_chats.insert_row(user_id, 'assistant', assistant_message, date_str)
   # 관리자 기록 저장
-  await context.bot.send_message(
-    chat_id=int(os.environ.get('TELEGRAM_ADMIN_FORUM_GROUP_ID')),
-    message_thread_id=room_info['admin_forum_id'],
-    text=assistant_message or 'Assistant message empty'
-  )
+  admin_queue.admin_queue.enqueue_text(user_id, user_name, assistant_message or 'Assistant message empty')
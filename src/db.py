@@ -3,7 +3,8 @@ import sqlite3
 import os
 import time
 import random
-from typing import List, Dict, Any, Generator, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Generator, Optional, Tuple
 import json
 
 from tqdm import tqdm
@@ -16,9 +17,27 @@ def safe_key_string(key: str) -> str:
     key = '_' + key
   return key
 
+# DB lock 대기 통계 (key: 테이블 이름), 진단용
+lock_wait_stats: Dict[str, Dict[str, float]] = {}
+
+def record_lock_wait(table_name: str, wait_seconds: float = 0.0, retry_count: int = 0, failed: bool = False) -> None:
+  stats = lock_wait_stats.setdefault(table_name, {
+    'retries': 0,
+    'wait_seconds': 0.0,
+    'max_retries_per_insert': 0,
+    'failures': 0,
+  })
+  if wait_seconds:
+    stats['retries'] += 1
+    stats['wait_seconds'] += wait_seconds
+  stats['max_retries_per_insert'] = max(stats['max_retries_per_insert'], retry_count)
+  if failed:
+    stats['failures'] += 1
+
 class Sqlite3Db:
   def __init__(self, db_file: str):
     self.conn = sqlite3.connect(db_file)
+    self.max_retry = 100
 
     self._db_file = db_file
 
@@ -39,9 +58,16 @@ class Sqlite3Db:
     return safe_key_string(key)
 
   def table_list(self) -> List[str]:
-    cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    cursor = self.conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+    rows = cursor.fetchall()
+    # Remove virtual tables (e.g. fts5) and their shadow tables, they are rebuilt from their source tables
+    virtual_tables = [name for name, sql in rows if sql and sql.upper().startswith('CREATE VIRTUAL TABLE')]
     # Remove default table like sqlite_sequence, ...
-    return [row[0] for row in cursor.fetchall() if not row[0].startswith('sqlite')]
+    return [
+      name for name, _ in rows
+      if not name.startswith('sqlite')
+      and not any(name == virtual or name.startswith(virtual + '_') for virtual in virtual_tables)
+    ]
 
   def has_table(self, table_name: str) -> bool:
     table_name = Sqlite3Db.ensure_safe_key_string(table_name)
@@ -50,8 +76,27 @@ class Sqlite3Db:
   
   def get_table_keys(self, table_name: str) -> List[str]:
     table_name = Sqlite3Db.ensure_safe_key_string(table_name)
-    self.conn.execute("SELECT * FROM {} LIMIT 0".format(table_name))
-    return [description[0] for description in self.conn.description]
+    cursor = self.conn.execute("SELECT * FROM {} LIMIT 0".format(table_name))
+    return [description[0] for description in cursor.description]
+
+  def get_table_sql(self, table_name: str) -> str:
+    table_name = Sqlite3Db.ensure_safe_key_string(table_name)
+    cursor = self.conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+  def cursor_reader_tuple(self, table_name: str, batch_size: int = 1000) -> Generator[List[Tuple[Any, ...]], None, None]:
+    # New cursor for transaction
+    cur = self.conn.cursor()
+    cur.execute('SELECT * FROM {}'.format(Sqlite3Db.ensure_safe_key_string(table_name)))
+    # Read batch
+    while True:
+      rows = cur.fetchmany(batch_size)
+      if not rows:
+        break
+      yield rows
+    # Close cursor
+    cur.close()
 
   def db_safe_insert_many_tuple(self, table_name: str, rows: List[Tuple[Any, ...]]) -> None:
     # New cursor for transaction
@@ -67,18 +112,29 @@ class Sqlite3Db:
         ), rows)
         cur.execute('COMMIT')
         cur.close()
+        if retry_count:
+          record_lock_wait(table_name, retry_count=retry_count)
         break
       except sqlite3.OperationalError as e:
         if 'database is locked' in str(e) and retry_count < self.max_retry:
           retry_count += 1
           print('🔒 Database is locked, retrying... ({} / {})'.format(retry_count, self.max_retry))
           # sleep random time between 0.1 and 0.5 seconds
-          time.sleep(0.1 + 0.4 * random.random())
+          wait_seconds = 0.1 + 0.4 * random.random()
+          time.sleep(wait_seconds)
+          record_lock_wait(table_name, wait_seconds=wait_seconds)
         else:
+          if 'database is locked' in str(e):
+            record_lock_wait(table_name, failed=True)
           # Rollback transaction
           cur.execute('ROLLBACK')
           cur.close()
           raise e
+      except Exception as e:
+        # Rollback transaction (e.g. constraint violation)
+        cur.execute('ROLLBACK')
+        cur.close()
+        raise e
 
 # Abstract class for sqlite3 table
 class Sqlite3Table:
@@ -135,18 +191,29 @@ class Sqlite3Table:
         ), rows)
         cur.execute('COMMIT')
         cur.close()
+        if retry_count:
+          record_lock_wait(self._table_name, retry_count=retry_count)
         break
       except sqlite3.OperationalError as e:
         if 'database is locked' in str(e) and retry_count < self.max_retry:
           retry_count += 1
           print('🔒 Database is locked, retrying... ({} / {})'.format(retry_count, self.max_retry))
           # sleep random time between 0.1 and 0.5 seconds
-          time.sleep(0.1 + 0.4 * random.random())
+          wait_seconds = 0.1 + 0.4 * random.random()
+          time.sleep(wait_seconds)
+          record_lock_wait(self._table_name, wait_seconds=wait_seconds)
         else:
+          if 'database is locked' in str(e):
+            record_lock_wait(self._table_name, failed=True)
           # Rollback transaction
           cur.execute('ROLLBACK')
           cur.close()
           raise e
+      except Exception as e:
+        # Rollback transaction (e.g. constraint violation)
+        cur.execute('ROLLBACK')
+        cur.close()
+        raise e
         
   def safe_insert_many_dict(self, rows: List[Dict[str, Any]]) -> None:
     # Ensure all keys are in the table
@@ -170,18 +237,29 @@ class Sqlite3Table:
         ), [tuple(row.values()) for row in rows])
         cur.execute('COMMIT')
         cur.close()
+        if retry_count:
+          record_lock_wait(self._table_name, retry_count=retry_count)
         break
       except sqlite3.OperationalError as e:
         if 'database is locked' in str(e) and retry_count < self.max_retry:
           retry_count += 1
           print('🔒 Database is locked, retrying... (try: {} / {})'.format(retry_count, self.max_retry))
           # sleep random time between 0.1 and 0.5 seconds
-          time.sleep(0.1 + 0.4 * random.random())
+          wait_seconds = 0.1 + 0.4 * random.random()
+          time.sleep(wait_seconds)
+          record_lock_wait(self._table_name, wait_seconds=wait_seconds)
         else:
+          if 'database is locked' in str(e):
+            record_lock_wait(self._table_name, failed=True)
           # Rollback transaction
           cur.execute('ROLLBACK')
           cur.close()
           raise e
+      except Exception as e:
+        # Rollback transaction (e.g. constraint violation)
+        cur.execute('ROLLBACK')
+        cur.close()
+        raise e
   
   def cursor_reader_tuple(self, batch_size: int = 1000) -> Generator[List[Tuple[Any, ...]], None, None]:
     # New cursor for transaction
@@ -225,21 +303,22 @@ class Sqlite3Utils:
             keys_to_merge,
             keys_to_merge_into
           ))
-      # Create table if not exists
+      # Create table if not exists (same schema as db_to_merge)
       elif not db_to_merge_into.has_table(table_name):
-        db_to_merge_into.conn.execute('CREATE TABLE {} AS SELECT * FROM {}'.format(
-          table_name,
-          table_name
-        ))
+        db_to_merge_into.conn.execute(db_to_merge.get_table_sql(table_name))
       # Insert rows with tqdm
       for rows in tqdm(
-        db_to_merge.cursor_reader_tuple(table_name),
+        db_to_merge.cursor_reader_tuple(table_name, batch_size=10000),
         desc='📖 Reading rows from {}'.format(table_name),
         leave=False
       ):
         db_to_merge_into.db_safe_insert_many_tuple(table_name, rows)
 
 class Sqlite3TableRoomInfo(Sqlite3Table):
+  """
+    유저 채팅방과 관리자 포럼 토픽의 매핑
+    - 양방향 매핑을 메모리에 두고 insert_row 때 함께 갱신 (조회 시 DB 접근 없음)
+  """
   def _init_db(self) -> None:
     self._db.conn.execute(
       'CREATE TABLE IF NOT EXISTS {} (\
@@ -247,10 +326,50 @@ class Sqlite3TableRoomInfo(Sqlite3Table):
       admin_forum_id INTEGER\
       )'.format(self._table_name)
     )
+    # user_id는 PRIMARY KEY라 별도 인덱스가 필요 없음
+    self._db.conn.execute(
+      'DROP INDEX IF EXISTS {}_user_id'.format(self._table_name)
+    )
+    self._create_admin_forum_index()
+    self._load_mapping()
+
+  def _create_admin_forum_index(self) -> None:
+    """
+      admin_forum_id 인덱스 (UNIQUE)
+      - 관리자 그룹이 바뀌는 등으로 이미 중복된 admin_forum_id가 있으면 시작을 막지 않도록
+        중복을 출력하고 일반 인덱스를 사용 (중복이 정리되면 다음 시작 때 UNIQUE로 바뀜)
+    """
+    index_name = '{}_admin_forum_id'.format(self._table_name)
+    duplicates = self._db.conn.execute(
+      'SELECT admin_forum_id, GROUP_CONCAT(user_id) FROM {} WHERE admin_forum_id IS NOT NULL GROUP BY admin_forum_id HAVING COUNT(*) > 1'.format(self._table_name)
+    ).fetchall()
+    unique = len(duplicates) == 0
+    if not unique:
+      print('⚠️ {}: 중복된 admin_forum_id {}개, UNIQUE 인덱스 대신 일반 인덱스를 사용합니다'.format(self._table_name, len(duplicates)))
+      for admin_forum_id, user_ids in duplicates:
+        print('  admin_forum_id {}: user_id {}'.format(admin_forum_id, user_ids))
+
+    row = self._db.conn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND name=?", (index_name,)).fetchone()
+    if row is not None and row[0].upper().startswith('CREATE UNIQUE') != unique:
+      self._db.conn.execute('DROP INDEX {}'.format(index_name))
     self._db.conn.execute(
-      'CREATE INDEX IF NOT EXISTS {}_user_id ON {} (user_id)'.format(self._table_name, self._table_name)
+      'CREATE {}INDEX IF NOT EXISTS {} ON {} (admin_forum_id)'.format('UNIQUE ' if unique else '', index_name, self._table_name)
     )
 
+  def _load_mapping(self) -> None:
+    self._user_to_forum: Dict[int, int] = {}
+    self._forum_to_user: Dict[int, int] = {}
+    cursor = self._db.conn.cursor()
+    cursor.execute('SELECT user_id, admin_forum_id FROM {}'.format(self._table_name))
+    for user_id, admin_forum_id in cursor.fetchall():
+      self._set_mapping(user_id, admin_forum_id)
+    cursor.close()
+
+  def _set_mapping(self, user_id: int, admin_forum_id: int) -> None:
+    self._user_to_forum[user_id] = admin_forum_id
+    if admin_forum_id is not None:
+      self._forum_to_user[admin_forum_id] = user_id
+
   def tuple_to_dict(self, row: Tuple[Any, ...]) -> Dict[str, Any]:
     return {
       'user_id': row[0],
@@ -258,36 +377,65 @@ class Sqlite3TableRoomInfo(Sqlite3Table):
     }
   
   def get_row_from_user_id(self, user_id: int) -> Dict[str, Any]:
-    cursor = self._db.conn.cursor()
-    cursor.execute('SELECT * FROM {} WHERE user_id=?'.format(self._table_name), (user_id,))
-    row = cursor.fetchone()
-    if row is None:
+    if user_id not in self._user_to_forum:
       return None
-    return self.tuple_to_dict(row)
+    return self.tuple_to_dict((user_id, self._user_to_forum[user_id]))
   
   def get_row_from_admin_forum_id(self, admin_forum_id: int) -> Dict[str, Any]:
-    cursor = self._db.conn.cursor()
-    cursor.execute('SELECT * FROM {} WHERE admin_forum_id=?'.format(self._table_name), (admin_forum_id,))
-    row = cursor.fetchone()
-    if row is None:
+    if admin_forum_id not in self._forum_to_user:
       return None
-    return self.tuple_to_dict(row)
+    return self.tuple_to_dict((self._forum_to_user[admin_forum_id], admin_forum_id))
 
   def insert_row(self, user_id: int, admin_forum_id: int) -> None:
     self.safe_insert_many_tuple([(user_id, admin_forum_id)])
+    self._set_mapping(user_id, admin_forum_id)
 
 class Sqlite3TableRoomChats(Sqlite3Table):
+  """
+    유저/AI 채팅 기록
+    - 최근 대화(hot)는 메인 DB에, retention_days가 지난 대화는 월별 아카이브 DB 파일로 이동
+      (archive_dir/{table_name}_YYYY_MM.db, rotate_partitions 참고)
+    - 최근 대화가 부족하면 해당 유저의 대화가 있는 아카이브만 열어서 이어서 조회
+  """
+  def __init__(
+    self,
+    sqlite3db: Sqlite3Db,
+    table_name: str,
+    archive_dir: str = 'chatbot_archive',
+    retention_days: int = 90,
+  ):
+    self.archive_dir = archive_dir
+    self.retention_days = retention_days
+    # 아카이브 읽기 전용 연결 (key: 'YYYY_MM')
+    self._partition_conns: Dict[str, sqlite3.Connection] = {}
+    # 유저별로 대화가 있는 아카이브 목록, 처음 필요할 때 로드
+    self._archive_user_months: Optional[Dict[int, List[str]]] = None
+    # 전문 검색 인덱스 (Sqlite3TableRoomChatsFts가 등록), 아카이브 DB에도 함께 만듦
+    self.fts: Optional['Sqlite3TableRoomChatsFts'] = None
+    super().__init__(sqlite3db, table_name)
+
   def _init_db(self) -> None:
+    self._create_table('main')
+
+  def _create_table(self, schema: str) -> None:
     # sender: 'user' or 'assistant'
     self._db.conn.execute(
-      'CREATE TABLE IF NOT EXISTS {} (\
+      'CREATE TABLE IF NOT EXISTS {}.{} (\
       id INTEGER PRIMARY KEY AUTOINCREMENT,\
       user_id INTEGER,\
       sender TEXT,\
       message TEXT,\
       date TEXT\
-      )'.format(self._table_name)
+      )'.format(schema, self._table_name)
+    )
+    self._db.conn.execute(
+      'CREATE INDEX IF NOT EXISTS {}.{}_user_id ON {} (user_id, id)'.format(schema, self._table_name, self._table_name)
     )
+    self._db.conn.execute(
+      'CREATE INDEX IF NOT EXISTS {}.{}_date ON {} (date)'.format(schema, self._table_name, self._table_name)
+    )
+    if self.fts is not None and schema != 'main':
+      self.fts.create_index(schema)
 
   # def safe_insert_many_tuple(self, rows: List[Tuple[Any, ...]]) -> None:
   #   # New cursor for transaction
@@ -327,9 +475,293 @@ class Sqlite3TableRoomChats(Sqlite3Table):
     self.safe_insert_many_tuple([(None, user_id, sender, message, date)])
 
   def get_last_rows_from_user_id(self, user_id: int, count: int) -> List[Dict[str, Any]]:
+    query = 'SELECT * FROM {} WHERE user_id=? ORDER BY id DESC LIMIT ?'.format(self._table_name)
     cursor = self._db.conn.cursor()
-    cursor.execute('SELECT * FROM {} WHERE user_id=? ORDER BY id DESC LIMIT ?'.format(self._table_name), (user_id, count))
-    return [self.tuple_to_dict(row) for row in cursor.fetchall()]
+    cursor.execute(query, (user_id, count))
+    rows = cursor.fetchall()
+    # 최근 대화가 부족하면 아카이브에서 최신 월부터 이어서 조회
+    if len(rows) < count:
+      for month in reversed(self._get_archive_user_months().get(user_id, [])):
+        cursor = self.partition_conn(month).cursor()
+        cursor.execute(query, (user_id, count - len(rows)))
+        rows += cursor.fetchall()
+        if len(rows) >= count:
+          break
+    return [self.tuple_to_dict(row) for row in rows]
+
+  def partition_path(self, month: str) -> str:
+    return os.path.join(self.archive_dir, '{}_{}.db'.format(self._table_name, month))
+
+  def partition_months(self) -> List[str]:
+    # 아카이브 월 목록 (오래된 순, 'YYYY_MM')
+    if not os.path.isdir(self.archive_dir):
+      return []
+    prefix = self._table_name + '_'
+    months = []
+    for file_name in os.listdir(self.archive_dir):
+      month = file_name[len(prefix):-len('.db')]
+      if file_name.startswith(prefix) and file_name.endswith('.db') and re.match(r'^[0-9]{4}_[0-9]{2}$', month):
+        months.append(month)
+    return sorted(months)
+
+  def partition_conn(self, month: str) -> sqlite3.Connection:
+    if month not in self._partition_conns:
+      self._partition_conns[month] = sqlite3.connect(
+        'file:{}?mode=ro'.format(self.partition_path(month)),
+        uri=True
+      )
+    return self._partition_conns[month]
+
+  def _get_archive_user_months(self) -> Dict[int, List[str]]:
+    if self._archive_user_months is None:
+      self._archive_user_months = {}
+      for month in self.partition_months():
+        cursor = self.partition_conn(month).cursor()
+        cursor.execute('SELECT DISTINCT user_id FROM {}'.format(self._table_name))
+        for (user_id,) in cursor.fetchall():
+          self._archive_user_months.setdefault(user_id, []).append(month)
+    return self._archive_user_months
+
+  def rotate_partitions(self, retention_days: Optional[int] = None, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+      retention_days가 지난 대화를 월별 아카이브 DB로 모두 이동 (db_tools rotate)
+      - 반환값: {'YYYY_MM': 이동한 행 수}
+    """
+    moved = {}
+    for partition_month, count in self.iter_rotate_partitions(retention_days, now):
+      moved[partition_month] = moved.get(partition_month, 0) + count
+    return moved
+
+  def iter_rotate_partitions(
+    self,
+    retention_days: Optional[int] = None,
+    now: Optional[datetime] = None,
+    batch_size: int = 500,
+  ) -> Generator[Tuple[str, int], None, None]:
+    """
+      retention_days가 지난 대화를 월별 아카이브 DB로 batch_size개씩 이동
+      - 묶음마다 아카이브 DB를 ATTACH해서 복사와 삭제를 한 트랜잭션으로 처리하고 ('YYYY_MM', 이동한 행 수)를 yield
+      - 한 묶음의 처리 시간이 짧으므로 봇에서는 묶음 사이에 이벤트 루프에 양보할 수 있음
+        (큰 DB에서 처음 이동할 때도 봇이 멈추지 않음)
+    """
+    if retention_days is None:
+      retention_days = self.retention_days
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+    cutoff_str = str(cutoff.replace(microsecond=0))
+
+    cursor = self._db.conn.cursor()
+    cursor.execute(
+      'SELECT DISTINCT substr(date, 1, 7) FROM {} WHERE date < ?'.format(self._table_name),
+      (cutoff_str,)
+    )
+    months = sorted(row[0] for row in cursor.fetchall() if row[0])
+    cursor.close()
+    if not months:
+      return
+
+    os.makedirs(self.archive_dir, exist_ok=True)
+    for month in months:
+      # 'YYYY-MM' 범위: [month, next_month) 와 cutoff 중 빠른 쪽
+      year, mon = int(month[:4]), int(month[5:7])
+      next_month = '{:04d}-{:02d}'.format(year + mon // 12, mon % 12 + 1)
+      end = min(next_month, cutoff_str)
+      partition_month = month.replace('-', '_')
+      while True:
+        count = self._move_to_partition(partition_month, month, end, batch_size)
+        if count == 0:
+          break
+        yield partition_month, count
+
+  def _move_to_partition(self, partition_month: str, start: str, end: str, batch_size: int) -> int:
+    # date가 [start, end)인 대화 최대 batch_size개를 아카이브로 이동
+    self._db.conn.commit()
+    self._db.conn.execute('ATTACH DATABASE ? AS archive', (self.partition_path(partition_month),))
+    try:
+      self._create_table('archive')
+      self._db.conn.commit()
+      cur = self._db.conn.cursor()
+      cur.execute('BEGIN TRANSACTION')
+      try:
+        # 옮길 id를 임시 테이블에 모아서 복사와 삭제가 같은 행을 대상으로 하도록 함
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS rotate_ids (id INTEGER PRIMARY KEY)')
+        cur.execute('DELETE FROM temp.rotate_ids')
+        cur.execute(
+          'INSERT INTO temp.rotate_ids SELECT id FROM main.{} WHERE date >= ? AND date < ? LIMIT ?'.format(self._table_name),
+          (start, end, batch_size)
+        )
+        cur.execute(
+          'INSERT INTO archive.{0} SELECT * FROM main.{0} WHERE id IN (SELECT id FROM temp.rotate_ids)'.format(self._table_name)
+        )
+        cur.execute(
+          'SELECT DISTINCT user_id FROM main.{} WHERE id IN (SELECT id FROM temp.rotate_ids)'.format(self._table_name)
+        )
+        moved_user_ids = [row[0] for row in cur.fetchall()]
+        cur.execute(
+          'DELETE FROM main.{} WHERE id IN (SELECT id FROM temp.rotate_ids)'.format(self._table_name)
+        )
+        count = cur.rowcount
+        cur.execute('DELETE FROM temp.rotate_ids')
+        cur.execute('COMMIT')
+      except Exception as e:
+        cur.execute('ROLLBACK')
+        raise e
+      finally:
+        cur.close()
+    finally:
+      self._db.conn.execute('DETACH DATABASE archive')
+
+    if count and self._archive_user_months is not None:
+      # 옮긴 유저들의 아카이브 월 목록에만 추가 (열려 있는 아카이브 연결은 새 행도 그대로 읽을 수 있음)
+      for user_id in moved_user_ids:
+        months = self._archive_user_months.setdefault(user_id, [])
+        if partition_month not in months:
+          months.append(partition_month)
+          months.sort()
+    return count
+
+
+
+class Sqlite3TableRoomChatsFts(Sqlite3Table):
+  """
+    room_chats.message 전문 검색 인덱스 (SQLite FTS5)
+    - room_chats의 INSERT/DELETE 트리거로 색인을 자동으로 맞춤 (rowid = room_chats.id)
+    - 월별 아카이브 DB에도 같은 인덱스와 트리거를 두어서, 아카이브로 이동한 대화는 메인 DB 색인에서 빠지고
+      아카이브 색인에 추가됨 (메인 DB 색인은 최근 대화만 유지)
+    - 한국어는 조사가 붙으므로 검색어마다 접두어 검색 ("수술" -> 수술, 수술은, 수술이 ...),
+      짧은 접두어는 prefix 인덱스 사용
+  """
+  prefix = '1 2'
+
+  def __init__(self, sqlite3db: Sqlite3Db, table_name: str, room_chats: Sqlite3TableRoomChats):
+    self._room_chats = room_chats
+    super().__init__(sqlite3db, table_name)
+
+  def _init_db(self) -> None:
+    # 아카이브로 이동할 때 아카이브 DB에도 색인을 만들도록 등록
+    self._room_chats.fts = self
+    # 예전 인덱스 (prefix 인덱스, DELETE 트리거 없음, 아카이브 대화 포함)는 다시 만듦
+    sql = self._db.get_table_sql(self._table_name)
+    if sql is not None and "prefix='{}'".format(self.prefix) not in sql:
+      print('🔎 {}: 검색 인덱스를 다시 만듭니다'.format(self._table_name))
+      self._db.conn.execute('DROP TRIGGER IF EXISTS {}_insert'.format(self._table_name))
+      self._db.conn.execute('DROP TABLE {}'.format(self._table_name))
+    # 처음 만들 때 기존 대화 색인
+    if self.create_index('main'):
+      self._db.conn.commit()
+      self.rebuild_archives()
+    self._db.conn.commit()
+
+  def create_index(self, schema: str) -> bool:
+    """
+      schema(main 또는 ATTACH한 아카이브)에 색인 테이블과 트리거를 만듦
+      - 새로 만든 경우 그 schema의 기존 대화를 색인하고 True 반환
+    """
+    created = self._db.conn.execute(
+      "SELECT name FROM {}.sqlite_master WHERE type='table' AND name=?".format(schema),
+      (self._table_name,)
+    ).fetchone() is None
+    self._db.conn.execute(
+      "CREATE VIRTUAL TABLE IF NOT EXISTS {}.{} USING fts5(\
+      message,\
+      user_id UNINDEXED,\
+      sender UNINDEXED,\
+      date UNINDEXED,\
+      tokenize='unicode61 remove_diacritics 2',\
+      prefix='{}'\
+      )".format(schema, self._table_name, self.prefix)
+    )
+    self._db.conn.execute(
+      'CREATE TRIGGER IF NOT EXISTS {0}.{1}_insert AFTER INSERT ON {2} BEGIN\
+      INSERT INTO {1} (rowid, message, user_id, sender, date) VALUES (new.id, new.message, new.user_id, new.sender, new.date);\
+      END'.format(schema, self._table_name, self._room_chats._table_name)
+    )
+    self._db.conn.execute(
+      'CREATE TRIGGER IF NOT EXISTS {0}.{1}_delete AFTER DELETE ON {2} BEGIN\
+      DELETE FROM {1} WHERE rowid = old.id;\
+      END'.format(schema, self._table_name, self._room_chats._table_name)
+    )
+    if created:
+      self._reindex(schema)
+    return created
+
+  def _reindex(self, schema: str) -> int:
+    self._db.conn.execute('DELETE FROM {}.{}'.format(schema, self._table_name))
+    cursor = self._db.conn.execute(
+      'INSERT INTO {0}.{1} (rowid, message, user_id, sender, date) SELECT id, message, user_id, sender, date FROM {0}.{2}'.format(
+        schema, self._table_name, self._room_chats._table_name
+      )
+    )
+    self._db.conn.execute("INSERT INTO {0}.{1} ({1}) VALUES ('optimize')".format(schema, self._table_name))
+    return cursor.rowcount
+
+  def rebuild(self, include_archives: bool = True) -> int:
+    # 메인 DB와 (include_archives면) 모든 아카이브의 대화를 다시 색인
+    self._db.conn.commit()
+    count = self._reindex('main')
+    self._db.conn.commit()
+    if include_archives:
+      count += self.rebuild_archives()
+    return count
+
+  def rebuild_archives(self) -> int:
+    count = 0
+    for month in self._room_chats.partition_months():
+      self._db.conn.commit()
+      self._db.conn.execute('ATTACH DATABASE ? AS archive', (self._room_chats.partition_path(month),))
+      try:
+        if not self.create_index('archive'):
+          count += self._reindex('archive')
+        else:
+          count += self._db.conn.execute('SELECT COUNT(*) FROM archive.{}'.format(self._table_name)).fetchone()[0]
+        self._db.conn.commit()
+      finally:
+        self._db.conn.execute('DETACH DATABASE archive')
+    return count
+
+  def tuple_to_dict(self, row: Tuple[Any, ...]) -> Dict[str, Any]:
+    return {
+      'id': row[0],
+      'user_id': row[1],
+      'sender': row[2],
+      'date': row[3],
+      'snippet': row[4],
+    }
+
+  @staticmethod
+  def build_match_query(text: str) -> str:
+    # 검색어를 FTS5 문법과 무관하게 접두어 검색 AND 조건으로 변환
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join('"{}"*'.format(term) for term in terms if term)
+
+  def search(
+    self,
+    text: str,
+    limit: int = 10,
+    offset: int = 0,
+    highlight: Tuple[str, str] = ('[', ']'),
+  ) -> List[Dict[str, Any]]:
+    """
+      메인 DB와 아카이브 색인에서 검색
+      - 결과는 색인별로 묶어서 메인 DB, 최신 아카이브 월 순으로 이어 붙임
+      - 관련도(bm25) 순서는 같은 색인 안에서만 유효함 (색인마다 통계가 달라 서로 비교할 수 없음)
+      - 반환값: id, user_id, sender, date, snippet (검색어는 highlight로 감쌈)
+    """
+    match_query = self.build_match_query(text)
+    if not match_query:
+      return []
+    query = "SELECT rowid, user_id, sender, date, snippet({0}, 0, ?, ?, '…', 16), rank FROM {0}\
+      WHERE {0} MATCH ? ORDER BY rank LIMIT ?".format(self._table_name)
+
+    # 앞 색인부터 offset + limit개가 찰 때까지 이어서 조회
+    rows = self._db.conn.execute(query, (highlight[0], highlight[1], match_query, offset + limit)).fetchall()
+    for month in reversed(self._room_chats.partition_months()):
+      if len(rows) >= offset + limit:
+        break
+      conn = self._room_chats.partition_conn(month)
+      if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (self._table_name,)).fetchone():
+        continue
+      rows += conn.execute(query, (highlight[0], highlight[1], match_query, offset + limit - len(rows))).fetchall()
+    return [self.tuple_to_dict(row) for row in rows[offset:offset + limit]]
 
 
 
@@ -388,9 +820,22 @@ def build_history(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 
 
 # Singletons
+# - chatbot.db는 처음 사용할 때 열어서 초기화 (db_tools 등에서 클래스만 import할 때 DB를 만들거나 변경하지 않도록)
 prompt_update_state = False
 ai_answer_state = True
-db = Sqlite3Db('chatbot.db')
-room_info = Sqlite3TableRoomInfo(db, 'room_info')
-room_chats = Sqlite3TableRoomChats(db, 'room_chats')
-config = Sqlite3TableConfig(db, 'config')
+_SINGLETONS = ('db', 'room_info', 'room_chats', 'room_chats_fts', 'config')
+
+def init(db_file: str = 'chatbot.db', archive_dir: str = 'chatbot_archive') -> None:
+  global db, room_info, room_chats, room_chats_fts, config
+  db = Sqlite3Db(db_file)
+  room_info = Sqlite3TableRoomInfo(db, 'room_info')
+  room_chats = Sqlite3TableRoomChats(db, 'room_chats', archive_dir=archive_dir)
+  room_chats_fts = Sqlite3TableRoomChatsFts(db, 'room_chats_fts', room_chats)
+  config = Sqlite3TableConfig(db, 'config')
+
+def __getattr__(name: str) -> Any:
+  # 모듈에 아직 없는 싱글톤에 접근하면 초기화
+  if name in _SINGLETONS:
+    init()
+    return globals()[name]
+  raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,414 @@
+"""
+  chatbot.db 데이터 관리 도구
+  - export: 테이블을 JSONL(.jsonl, .jsonl.gz) 또는 Parquet(.parquet)으로 스트리밍 내보내기
+  - import: JSONL/Parquet 파일을 배치 트랜잭션으로 대량 가져오기 (로드 중 인덱스 제거 후 재생성)
+  - backup: 서비스 중에도 가능한 온라인 백업 (sqlite3 backup API)
+  - archive: 오래된 room_chats 대화를 콜드 스토리지 파일로 옮기고 삭제
+  - rotate: 보관 기간이 지난 room_chats 대화를 월별 아카이브 DB로 이동
+  - vacuum: DB 파일 크기 정리
+
+  사용 예)
+    python db_tools.py export --db chatbot.db --table room_chats --output room_chats.jsonl.gz
+    python db_tools.py import --db chatbot.db --table room_chats --input room_chats.parquet
+    python db_tools.py backup --db chatbot.db --output backup/chatbot.db
+    python db_tools.py archive --db chatbot.db --before 2024-06-01 --output-dir archive --vacuum
+    python db_tools.py rotate --db chatbot.db --archive-dir chatbot_archive --retention-days 90
+    python db_tools.py export --db chatbot.db --output all_chats.parquet --archive-dir chatbot_archive
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from db import Sqlite3Db, Sqlite3TableConfig, Sqlite3TableRoomChats, Sqlite3TableRoomChatsFts, Sqlite3TableRoomInfo
+
+
+
+
+
+# import 대상 테이블이 없을 때 스키마를 만들 클래스
+TABLE_CLASSES = {
+  'room_info': Sqlite3TableRoomInfo,
+  'room_chats': Sqlite3TableRoomChats,
+  'config': Sqlite3TableConfig,
+}
+
+def _file_format(path: str) -> str:
+  if path.endswith('.parquet'):
+    return 'parquet'
+  if path.endswith('.jsonl.gz'):
+    return 'jsonl.gz'
+  if path.endswith('.jsonl'):
+    return 'jsonl'
+  raise Exception('Unsupported file format (path: {}). Use .jsonl, .jsonl.gz or .parquet'.format(path))
+
+def _import_pyarrow():
+  try:
+    import pyarrow
+    import pyarrow.parquet
+  except ImportError:
+    raise Exception('pyarrow is required for parquet files (pip install pyarrow)')
+  return pyarrow
+
+def _ensure_parent_dir(path: str) -> None:
+  parent = os.path.dirname(path)
+  if parent:
+    os.makedirs(parent, exist_ok=True)
+
+
+
+def iter_query_batches(
+  conn: sqlite3.Connection,
+  query: str,
+  params: Tuple[Any, ...] = (),
+  batch_size: int = 10000,
+) -> Generator[Tuple[List[str], List[Tuple[Any, ...]]], None, None]:
+  # 쿼리 결과를 batch_size 단위로 읽기 (메모리 사용량은 배치 크기로 제한)
+  cur = conn.cursor()
+  cur.execute(query, params)
+  columns = [description[0] for description in cur.description]
+  while True:
+    rows = cur.fetchmany(batch_size)
+    if not rows:
+      break
+    yield columns, rows
+  cur.close()
+
+def write_batches(
+  output_path: str,
+  batches: Iterable[Tuple[List[str], List[Tuple[Any, ...]]]],
+) -> int:
+  # 배치들을 파일로 스트리밍 저장, 임시 파일에 쓴 뒤 완료되면 교체
+  file_format = _file_format(output_path)
+  _ensure_parent_dir(output_path)
+  tmp_path = output_path + '.tmp'
+  count = 0
+
+  if file_format == 'parquet':
+    pa = _import_pyarrow()
+    writer = None
+    try:
+      for columns, rows in batches:
+        table = pa.Table.from_pylist([dict(zip(columns, row)) for row in rows])
+        if writer is None:
+          writer = pa.parquet.ParquetWriter(tmp_path, table.schema, compression='zstd')
+        writer.write_table(table.cast(writer.schema))
+        count += len(rows)
+    finally:
+      if writer is not None:
+        writer.close()
+    if writer is None:
+      # 빈 결과는 파일을 만들지 않음
+      return 0
+  else:
+    open_file = gzip.open if file_format == 'jsonl.gz' else open
+    with open_file(tmp_path, 'wt', encoding='utf-8') as f:
+      for columns, rows in batches:
+        for row in rows:
+          f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+          f.write('\n')
+        count += len(rows)
+    if count == 0:
+      os.remove(tmp_path)
+      return 0
+
+  os.replace(tmp_path, output_path)
+  return count
+
+def read_batches(
+  input_path: str,
+  batch_size: int = 10000,
+) -> Generator[List[Dict[str, Any]], None, None]:
+  # 파일을 batch_size 단위로 읽기
+  file_format = _file_format(input_path)
+
+  if file_format == 'parquet':
+    pa = _import_pyarrow()
+    parquet_file = pa.parquet.ParquetFile(input_path)
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+      yield record_batch.to_pylist()
+    return
+
+  open_file = gzip.open if file_format == 'jsonl.gz' else open
+  with open_file(input_path, 'rt', encoding='utf-8') as f:
+    rows = []
+    for line in f:
+      if not line.strip():
+        continue
+      rows.append(json.loads(line))
+      if len(rows) >= batch_size:
+        yield rows
+        rows = []
+    if rows:
+      yield rows
+
+
+
+def export_table(
+  db: Sqlite3Db,
+  table_name: str,
+  output_path: str,
+  where: str = '',
+  params: Tuple[Any, ...] = (),
+  batch_size: int = 10000,
+  archive_dir: Optional[str] = None,
+) -> int:
+  """
+    테이블을 파일로 내보내기
+    - archive_dir가 있으면 room_chats의 월별 아카이브(오래된 순)를 먼저 내보내고 메인 DB를 이어서 내보냄
+  """
+  table_name = Sqlite3Db.ensure_safe_key_string(table_name)
+  query = 'SELECT * FROM {}'.format(table_name)
+  if where:
+    query += ' WHERE ' + where
+
+  def iter_all_batches():
+    if archive_dir is not None:
+      room_chats = Sqlite3TableRoomChats(db, table_name, archive_dir=archive_dir)
+      for month in room_chats.partition_months():
+        yield from iter_query_batches(room_chats.partition_conn(month), query, params, batch_size)
+    yield from iter_query_batches(db.conn, query, params, batch_size)
+
+  return write_batches(
+    output_path,
+    tqdm(iter_all_batches(), desc='📤 Exporting {}'.format(table_name), unit='batch'),
+  )
+
+def import_table(
+  db: Sqlite3Db,
+  table_name: str,
+  input_path: str,
+  batch_size: int = 10000,
+  new_ids: bool = False,
+) -> int:
+  """
+    파일의 행들을 테이블에 대량으로 추가
+    - 테이블이 없으면 봇과 같은 스키마로 생성
+    - 배치마다 하나의 트랜잭션으로 커밋
+    - 로드 중에는 일반 인덱스와 트리거(검색 인덱스 갱신)를 제거했다가 끝난 뒤 다시 생성
+      (UNIQUE 인덱스는 유지해서 중복 행이 들어가지 않도록 함)
+    - room_chats는 로드 후 메인 DB 검색 인덱스를 다시 만듦
+    - new_ids가 True면 id 컬럼을 버리고 새로 발급 (다른 DB의 데이터를 합칠 때)
+  """
+  table_name = Sqlite3Db.ensure_safe_key_string(table_name)
+  if not db.has_table(table_name):
+    if table_name not in TABLE_CLASSES:
+      raise Exception('Table not found: {}'.format(table_name))
+    TABLE_CLASSES[table_name](db, table_name)
+  table_keys = db.get_table_keys(table_name)
+  db.conn.commit()
+
+  # 일반 인덱스와 트리거 제거 (자동 생성 인덱스는 sql이 NULL)
+  cursor = db.conn.execute(
+    "SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name=? AND sql IS NOT NULL",
+    (table_name,)
+  )
+  dropped = [
+    (object_type, name, sql) for object_type, name, sql in cursor.fetchall()
+    if not sql.upper().startswith('CREATE UNIQUE')
+  ]
+  for object_type, name, _ in dropped:
+    db.conn.execute('DROP {} IF EXISTS {}'.format(object_type.upper(), name))
+  db.conn.commit()
+
+  synchronous = db.conn.execute('PRAGMA synchronous').fetchone()[0]
+  db.conn.execute('PRAGMA synchronous=OFF')
+  count = 0
+  try:
+    for rows in tqdm(read_batches(input_path, batch_size), desc='📥 Importing {}'.format(table_name), unit='batch'):
+      keys = [key for key in rows[0].keys() if key in table_keys and not (new_ids and key == 'id')]
+      cur = db.conn.cursor()
+      cur.execute('BEGIN TRANSACTION')
+      try:
+        cur.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+          table_name,
+          ",".join(keys),
+          ",".join(["?"] * len(keys))
+        ), [tuple(row.get(key) for key in keys) for row in rows])
+        cur.execute('COMMIT')
+      except Exception as e:
+        cur.execute('ROLLBACK')
+        raise e
+      finally:
+        cur.close()
+      count += len(rows)
+  finally:
+    db.conn.execute('PRAGMA synchronous={}'.format(int(synchronous)))
+    # 인덱스와 트리거를 하나씩 다시 생성 (하나가 실패해도 나머지는 생성)
+    failed = []
+    for object_type, name, sql in dropped:
+      try:
+        db.conn.execute(sql)
+        db.conn.commit()
+      except sqlite3.Error as e:
+        db.conn.rollback()
+        print('⚠️ Failed to recreate {} {}: {}'.format(object_type, name, e))
+        failed.append(name)
+    # 트리거가 꺼져 있는 동안 추가된 행을 검색 인덱스에 반영
+    if table_name == 'room_chats' and any(object_type == 'trigger' for object_type, _, _ in dropped):
+      room_chats = Sqlite3TableRoomChats(db, table_name)
+      Sqlite3TableRoomChatsFts(db, 'room_chats_fts', room_chats).rebuild(include_archives=False)
+  if failed:
+    raise Exception('Failed to recreate: {}'.format(', '.join(failed)))
+  return count
+
+def backup_db(
+  db: Sqlite3Db,
+  output_path: str,
+  pages: int = 1024,
+) -> None:
+  # 온라인 백업: pages 단위로 복사하면서 다른 연결의 쓰기를 막지 않음
+  _ensure_parent_dir(output_path)
+  tmp_path = output_path + '.tmp'
+  if os.path.exists(tmp_path):
+    os.remove(tmp_path)
+  progress_bar = tqdm(desc='💾 Backup', unit='page')
+
+  def progress(status, remaining, total):
+    progress_bar.total = total
+    progress_bar.n = total - remaining
+    progress_bar.refresh()
+
+  backup_conn = sqlite3.connect(tmp_path)
+  try:
+    db.conn.backup(backup_conn, pages=pages, progress=progress)
+  finally:
+    backup_conn.close()
+    progress_bar.close()
+  os.replace(tmp_path, output_path)
+
+def vacuum_db(db: Sqlite3Db) -> None:
+  db.conn.commit()
+  db.conn.execute('VACUUM')
+
+def archive_room_chats(
+  db: Sqlite3Db,
+  before_date: str,
+  output_dir: str,
+  table_name: str = 'room_chats',
+  file_format: str = 'jsonl.gz',
+  batch_size: int = 10000,
+) -> Optional[str]:
+  """
+    before_date 이전의 대화를 output_dir의 파일로 옮기고 테이블에서 삭제
+    - 파일 저장이 끝난 뒤에만 삭제하며, 내보낸 마지막 id까지만 삭제
+  """
+  table_name = Sqlite3Db.ensure_safe_key_string(table_name)
+  max_id = db.conn.execute(
+    'SELECT MAX(id) FROM {} WHERE date < ?'.format(table_name),
+    (before_date,)
+  ).fetchone()[0]
+  if max_id is None:
+    return None
+
+  output_path = os.path.join(output_dir, '{}_before_{}.{}'.format(
+    table_name,
+    re.sub(r'[^0-9A-Za-z-]', '_', before_date),
+    file_format
+  ))
+  count = export_table(
+    db,
+    table_name,
+    output_path,
+    where='date < ? AND id <= ?',
+    params=(before_date, max_id),
+    batch_size=batch_size,
+  )
+
+  db.conn.commit()
+  cur = db.conn.cursor()
+  cur.execute('BEGIN TRANSACTION')
+  try:
+    cur.execute('DELETE FROM {} WHERE date < ? AND id <= ?'.format(table_name), (before_date, max_id))
+    deleted = cur.rowcount
+    cur.execute('COMMIT')
+  except Exception as e:
+    cur.execute('ROLLBACK')
+    raise e
+  finally:
+    cur.close()
+  if deleted != count:
+    print('⚠️ Archived {} rows but deleted {} rows'.format(count, deleted))
+  return output_path
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='chatbot.db data tools')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  export_parser = subparsers.add_parser('export', help='Export a table to .jsonl, .jsonl.gz or .parquet')
+  export_parser.add_argument('--db', default='chatbot.db')
+  export_parser.add_argument('--table', default='room_chats')
+  export_parser.add_argument('--output', required=True)
+  export_parser.add_argument('--batch-size', type=int, default=10000)
+  export_parser.add_argument('--archive-dir', default=None, help='Also export room_chats monthly archives in this directory (default for room_chats: chatbot_archive)')
+
+  import_parser = subparsers.add_parser('import', help='Bulk import .jsonl, .jsonl.gz or .parquet into a table')
+  import_parser.add_argument('--db', default='chatbot.db')
+  import_parser.add_argument('--table', default='room_chats')
+  import_parser.add_argument('--input', required=True)
+  import_parser.add_argument('--batch-size', type=int, default=10000)
+  import_parser.add_argument('--new-ids', action='store_true', help='Drop id column and assign new ids')
+
+  backup_parser = subparsers.add_parser('backup', help='Online backup of the database')
+  backup_parser.add_argument('--db', default='chatbot.db')
+  backup_parser.add_argument('--output', required=True)
+
+  archive_parser = subparsers.add_parser('archive', help='Move old room_chats rows into a cold storage file')
+  archive_parser.add_argument('--db', default='chatbot.db')
+  archive_parser.add_argument('--before', required=True, help='Archive rows with date before this (e.g. 2024-06-01)')
+  archive_parser.add_argument('--output-dir', default='archive')
+  archive_parser.add_argument('--format', default='jsonl.gz', choices=['jsonl', 'jsonl.gz', 'parquet'])
+  archive_parser.add_argument('--vacuum', action='store_true')
+
+  rotate_parser = subparsers.add_parser('rotate', help='Move room_chats rows older than retention into monthly archive databases')
+  rotate_parser.add_argument('--db', default='chatbot.db')
+  rotate_parser.add_argument('--archive-dir', default='chatbot_archive')
+  rotate_parser.add_argument('--retention-days', type=int, default=90)
+
+  vacuum_parser = subparsers.add_parser('vacuum', help='VACUUM the database')
+  vacuum_parser.add_argument('--db', default='chatbot.db')
+
+  args = parser.parse_args()
+  db = Sqlite3Db(args.db)
+
+  if args.command == 'export':
+    if args.archive_dir is None and args.table == 'room_chats':
+      args.archive_dir = 'chatbot_archive'
+    count = export_table(db, args.table, args.output, batch_size=args.batch_size, archive_dir=args.archive_dir)
+    print('Exported {} rows to {}'.format(count, args.output))
+  elif args.command == 'import':
+    count = import_table(db, args.table, args.input, batch_size=args.batch_size, new_ids=args.new_ids)
+    print('Imported {} rows from {}'.format(count, args.input))
+  elif args.command == 'backup':
+    backup_db(db, args.output)
+    print('Backup saved to {}'.format(args.output))
+  elif args.command == 'archive':
+    output_path = archive_room_chats(db, args.before, args.output_dir, file_format=args.format)
+    print('Archived to {}'.format(output_path) if output_path else 'Nothing to archive')
+    if args.vacuum:
+      vacuum_db(db)
+  elif args.command == 'rotate':
+    room_chats = Sqlite3TableRoomChats(db, 'room_chats', archive_dir=args.archive_dir)
+    # 아카이브 DB에도 검색 인덱스를 만들도록 함께 로드
+    Sqlite3TableRoomChatsFts(db, 'room_chats_fts', room_chats)
+    moved = room_chats.rotate_partitions(args.retention_days)
+    for month, count in moved.items():
+      print('Moved {} rows to {}'.format(count, room_chats.partition_path(month)))
+    if not moved:
+      print('Nothing to rotate')
+  elif args.command == 'vacuum':
+    vacuum_db(db)
+
+  db.close()
+
+
+
+if __name__ == '__main__':
+  main()
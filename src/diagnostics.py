@@ -0,0 +1,129 @@
+import asyncio
+import gc
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Any, Dict, List
+
+
+
+def sample_thread_stacks(
+  thread_id: int,
+  duration: float = 10.0,
+  interval: float = 0.005,
+) -> Counter:
+  """
+    샘플링 프로파일러: duration 동안 interval마다 thread_id 스레드의 스택을 수집
+    - 반환값: {collapsed stack ('file:func:line;...', 바깥쪽부터): 샘플 수}
+    - 이벤트 루프 스레드를 멈추지 않도록 다른 스레드에서 실행해야 함 (asyncio.to_thread)
+  """
+  samples = Counter()
+  deadline = time.monotonic() + duration
+  while time.monotonic() < deadline:
+    frame = sys._current_frames().get(thread_id)
+    if frame is not None:
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+      samples[';'.join(reversed(stack))] += 1
+    time.sleep(interval)
+  return samples
+
+async def profile_event_loop(duration: float = 10.0, interval: float = 0.005) -> Counter:
+  # 현재 이벤트 루프 스레드를 다른 스레드에서 샘플링
+  return await asyncio.to_thread(sample_thread_stacks, threading.get_ident(), duration, interval)
+
+def format_profile(samples: Counter, top: int = 30) -> str:
+  """
+    프로파일 결과를 텍스트로 변환
+    - 함수별 self/total 샘플 비율 상위 top개
+    - 마지막에 flamegraph.pl / speedscope에서 열 수 있는 collapsed stack 형식 전체
+  """
+  total = sum(samples.values())
+  if total == 0:
+    return 'No samples\n'
+  self_counts = Counter()
+  total_counts = Counter()
+  for stack, count in samples.items():
+    frames = stack.split(';')
+    self_counts[frames[-1]] += count
+    for frame in set(frames):
+      total_counts[frame] += count
+
+  lines = ['# samples: {}'.format(total), '', '# top self']
+  for frame, count in self_counts.most_common(top):
+    lines.append('{:6.1f}%  {}'.format(count / total * 100, frame))
+  lines += ['', '# top total']
+  for frame, count in total_counts.most_common(top):
+    lines.append('{:6.1f}%  {}'.format(count / total * 100, frame))
+  lines += ['', '# collapsed stacks']
+  for stack, count in samples.most_common():
+    lines.append('{} {}'.format(stack, count))
+  return '\n'.join(lines) + '\n'
+
+
+
+def task_summary(top: int = 20) -> List[str]:
+  # 실행 중인 asyncio task를 코루틴 이름별로 집계
+  tasks = asyncio.all_tasks()
+  counts = Counter()
+  for task in tasks:
+    coro = task.get_coro()
+    counts[getattr(coro, '__qualname__', repr(coro))] += 1
+  lines = ['tasks: {}'.format(len(tasks))]
+  for name, count in counts.most_common(top):
+    lines.append('  {:4d}  {}'.format(count, name))
+  return lines
+
+def thread_stacks() -> List[str]:
+  # 모든 스레드의 현재 스택
+  names = {thread.ident: thread.name for thread in threading.enumerate()}
+  lines = []
+  for thread_id, frame in sys._current_frames().items():
+    lines.append('--- thread {} ({})'.format(names.get(thread_id, '?'), thread_id))
+    lines += [line.rstrip('\n') for line in traceback.format_stack(frame)]
+  return lines
+
+def memory_summary(components: Dict[str, Any], top: int = 20) -> List[str]:
+  """
+    메모리 사용량
+    - 프로세스(및 자식 프로세스) RSS
+    - components: {이름: 항목 수} 형태의 컴포넌트별 크기
+    - gc가 추적하는 객체 수 상위 타입
+  """
+  lines = []
+  try:
+    import psutil
+    process = psutil.Process()
+    lines.append('rss: {:.1f} MiB'.format(process.memory_info().rss / 1024 / 1024))
+    for child in process.children(recursive=True):
+      try:
+        lines.append('  child {} rss: {:.1f} MiB'.format(child.pid, child.memory_info().rss / 1024 / 1024))
+      except psutil.Error:
+        pass
+  except ImportError:
+    import resource
+    lines.append('max rss: {:.1f} MiB (psutil not installed)'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+  lines.append('components:')
+  for name, size in components.items():
+    lines.append('  {:40s} {}'.format(name, size))
+
+  type_counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+  lines.append('gc objects: {} (top types)'.format(sum(type_counts.values())))
+  for name, count in type_counts.most_common(top):
+    lines.append('  {:10d}  {}'.format(count, name))
+  return lines
+
+def build_report(sections: Dict[str, List[str]]) -> str:
+  lines = ['# diagnostics {}'.format(time.strftime('%Y-%m-%d %H:%M:%S')), '']
+  for title, section_lines in sections.items():
+    lines.append('## ' + title)
+    lines += section_lines
+    lines.append('')
+  return '\n'.join(lines) + '\n'
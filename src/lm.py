@@ -1,89 +1,21 @@
-from huggingface_hub import hf_hub_download, snapshot_download
+from huggingface_hub import snapshot_download
 from vllm import LLM, SamplingParams
 import json
 from pathlib import Path
 from typing import Optional, Union
-import os
+import asyncio
+import random
+import threading
+import time
 
+import httpx
 import openai
 
 import db
+from lm_cpu import VpsbLmCpuServer
 
 
 
-def run_gguf_inference(
-  model_path: str,
-  tokenizer_path: str,
-):
-  # PROMPT_TEMPLATE = "<|system|>\n{system_message}</s>\n<|user|>\n{prompt}</s>\n<|assistant|>\n"  # noqa: E501
-  # system_message = "You are a friendly chatbot who always responds in the language of the person who spoke to you."  # noqa: E501
-  # # Sample prompts.
-  # prompts = [
-  #   # "How many helicopters can a human eat in one sitting?",
-  #   # "What's the future of AI?",
-  #   "한 사람이 한 번에 먹을 수 있는 헬리콥터는 몇 대인가요?"
-  # ]
-  # prompts = [
-  #   PROMPT_TEMPLATE.format(system_message=system_message, prompt=prompt)
-  #   for prompt in prompts
-  # ]
-  messages = [
-    {"role": "system", "content": "You are a friendly chatbot who always responds in the language of the person who spoke to you."},
-    {"role": "user", "content": "Hello, how are you?"},
-    {"role": "assistant", "content": "I'm doing well, thank you!"},
-    {"role": "user", "content": "한 사람이 한 번에 먹을 수 있는 헬리콥터는 몇 대인가요?"}
-  ]
-  # Create a sampling params object.
-  sampling_params = SamplingParams(
-    temperature=0,
-    max_tokens=2048,
-  )
-
-  # Create an LLM.
-  llm = LLM(
-    model=model_path,
-    tokenizer=tokenizer_path,
-    gpu_memory_utilization=0.95,
-  )
-
-  # outputs = llm.generate(prompts, sampling_params)
-  res = llm.chat(
-    messages=messages,
-    sampling_params=sampling_params,
-
-  )
-  print(res)
-  # Print the outputs.
-  # for output in outputs:
-  #   prompt = output.prompt
-  #   generated_text = output.outputs[0].text
-  #   print(f"Prompt: {prompt!r}, Generated text: {generated_text!r}")
-
-
-
-if __name__ == "__main__":
-  model_model = hf_hub_download(
-    "gphorvath/Ministral-8B-Instruct-2410-Q4_K_M-GGUF",
-    filename="ministral-8b-instruct-2410-q4_k_m.gguf",
-    cache_dir="./hf_cache"
-  )
-  model_tokenizer = hf_hub_download(
-    "mistralai/Ministral-8B-Instruct-2410",
-    filename="tokenizer.json",
-    cache_dir="./hf_cache"
-  )
-  model_tokenizer_config = hf_hub_download(
-    "mistralai/Ministral-8B-Instruct-2410",
-    filename="tokenizer_config.json",
-    cache_dir="./hf_cache"
-  )
-  model_tokenizer_dir = os.path.dirname(model_tokenizer)
-
-  run_gguf_inference(
-    model_path=model_model,
-    tokenizer_path=model_tokenizer_dir
-  )
-
 class VpsbLmServer:
   """
     뷰성형외과 봇의 언어모델을 관리 클래스
@@ -155,17 +87,119 @@ class VpsbLmServer:
     return res[0].outputs[0].text
 
 
+class LmUnavailableError(Exception):
+  """
+    언어모델 백엔드에 연결할 수 없을 때 발생하는 예외
+  """
+  pass
+
+
+class CircuitBreaker:
+  """
+    언어모델 백엔드 장애 시 빠르게 실패하기 위한 서킷 브레이커
+    - closed: 정상 상태, 모든 요청 허용
+    - open: 연속 실패가 failure_threshold 이상이면 reset_timeout 동안 모든 요청 차단
+    - half_open: reset_timeout 이후 한 개의 시험 요청만 허용, 성공하면 closed로 복귀
+  """
+  def __init__(
+    self,
+    failure_threshold: int = 3,
+    reset_timeout: float = 30.0,
+  ):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.state = 'closed'
+    self.failure_count = 0
+    self.opened_at = 0.0
+    self._probe_in_flight = False
+    self._lock = threading.Lock()
+
+  def is_open(self) -> bool:
+    # 상태를 바꾸지 않고 요청이 차단될지 확인
+    with self._lock:
+      if self.state == 'open':
+        return (time.monotonic() - self.opened_at) < self.reset_timeout
+      if self.state == 'half_open':
+        return self._probe_in_flight
+      return False
+
+  def allow(self) -> bool:
+    with self._lock:
+      if self.state == 'closed':
+        return True
+      if self.state == 'open':
+        if (time.monotonic() - self.opened_at) < self.reset_timeout:
+          return False
+        self.state = 'half_open'
+        self._probe_in_flight = False
+      # half_open: 시험 요청은 하나만
+      if self._probe_in_flight:
+        return False
+      self._probe_in_flight = True
+      return True
+
+  def record_success(self) -> None:
+    with self._lock:
+      self.state = 'closed'
+      self.failure_count = 0
+      self._probe_in_flight = False
+
+  def release_probe(self) -> None:
+    # 성공/실패를 판단할 수 없는 경우 (소비자가 스트림을 닫음, 잘못된 요청 등) 상태는 그대로 두고 시험 요청만 해제
+    with self._lock:
+      self._probe_in_flight = False
+
+  def record_failure(self) -> None:
+    with self._lock:
+      self.failure_count += 1
+      self._probe_in_flight = False
+      if self.state == 'half_open' or self.failure_count >= self.failure_threshold:
+        if self.state != 'open':
+          print('🔌 LM backend circuit opened (failures: {})'.format(self.failure_count))
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+
+
+# 재시도해도 되는 일시적인 오류 (연결 실패, 타임아웃, 5xx, 스트림 중간 끊김)
+RETRYABLE_ERRORS = (
+  openai.APIConnectionError,
+  openai.InternalServerError,
+  openai.RateLimitError,
+  httpx.TransportError,
+)
+
+
 class VpsbLmServer2:
 
   model_name = "Qwen/Qwen2.5-14B-Instruct-AWQ"
 
   def __init__(
     self,
+    base_url: str = "http://127.0.0.1:8000/v1",  # 실제 로컬 서버 주소로 변경하세요
+    model_name: Optional[str] = None,  # 기본값: 클래스의 model_name
+    connect_timeout: float = 3.0,  # 연결 타임아웃(초)
+    read_timeout: float = 30.0,  # 토큰 사이 최대 대기 시간(초)
+    max_retries: int = 2,  # 스트림 실패 시 이어서 재시도할 횟수
+    retry_backoff: float = 0.5,  # 재시도 대기 시간(초), 시도마다 2배
+    circuit_breaker: Optional[CircuitBreaker] = None,
+    fallback: Optional[VpsbLmCpuServer] = None,  # 장애/포화 시 사용할 CPU 언어모델
+    max_in_flight: Optional[int] = None,  # 동시 요청이 이 이상이면 fallback 사용
   ):
     self.client = openai.OpenAI(
-      base_url="http://127.0.0.1:8000/v1",  # 실제 로컬 서버 주소로 변경하세요
-      api_key="not-needed"  # 로컬 서버에서는 실제 API 키가 필요 없을 수 있습니다
+      base_url=base_url,
+      api_key="not-needed",  # 로컬 서버에서는 실제 API 키가 필요 없을 수 있습니다
+      timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+      max_retries=0,  # 재시도는 chat_stream에서 직접 처리
     )
+    if model_name is not None:
+      self.model_name = model_name
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.circuit_breaker = circuit_breaker or CircuitBreaker()
+    self.fallback = fallback
+    self.max_in_flight = max_in_flight
+    self.in_flight = 0
+    self._in_flight_lock = threading.Lock()  # 스트림은 여러 스레드에서 동시에 실행될 수 있음
 
     config = db.config.load_config()
     self.system_message = config.get('system_prompt') or  "You are a professional plastic surgery consultant."
@@ -185,49 +219,203 @@ class VpsbLmServer2:
     )
     assistant_message = res.choices[0].message.content
     return assistant_message
-  
-  def chat_stream(
+
+  def _chat_stream_once(
     self,
     messages: list[dict[str, str]],
-    complete_callback: Optional[callable] = None,
+    partial_message: str = "",
   ):
-    messages = [
-      {"role": "system", "content": self.system_message},
-      *messages
-    ]
+    """
+      한 번의 스트리밍 요청
+      - partial_message가 있으면 이전 답변에 이어서 생성 (vllm continue_final_message)
+    """
+    extra_body = None
+    if partial_message:
+      messages = [
+        *messages,
+        {"role": "assistant", "content": partial_message},
+      ]
+      extra_body = {
+        'add_generation_prompt': False,
+        'continue_final_message': True,
+      }
     chat_stream = self.client.chat.completions.create(
       model=self.model_name,
       messages=messages,
       temperature=0.7,
       stream=True,
+      extra_body=extra_body,
     )
-    assistant_message = ""
-
-    def build_history():
-      return assistant_message
-
-    def finish_inference():
-      if complete_callback is not None:
-        complete_callback(assistant_message)
 
     for chunk in chat_stream:
+      if not chunk.choices:
+        continue
       finish_reason = chunk.choices[0].finish_reason
-      role = chunk.choices[0].delta.role
       content = chunk.choices[0].delta.content
-      
-      if role == 'assistant':
-        assistant_message = ''
-      
+
       if type(content) == str:
-        if assistant_message is None:
-          raise Exception("Content before role setted")
-        assistant_message += content
-        yield content #build_history()
+        if content:
+          yield content
+        if finish_reason is not None:
+          return
       elif finish_reason == 'stop':
-        return finish_inference()
+        return
       else:
         print("Unexpected chunk", chunk)
-        return finish_inference()
+        return
+
+    # 완료 표시 없이 스트림이 끊긴 경우
+    raise httpx.RemoteProtocolError('Inference unexpected end')
+
+  def is_available(self) -> bool:
+    # 서킷이 열려 있어도 fallback이 있으면 답변 가능
+    return not self.circuit_breaker.is_open() or self._fallback_available()
+
+  def _fallback_available(self) -> bool:
+    # CPU 워커가 준비됐고 대기 요청이 max_pending보다 적을 때만 사용 (CPU 큐에서 오래 기다리지 않도록)
+    return self.fallback is not None and self.fallback.has_capacity()
+
+  def _fallback_stream(
+    self,
+    messages: list[dict[str, str]],
+    complete_callback: Optional[callable] = None,
+  ):
+    self.fallback.system_message = self.system_message
+    try:
+      yield from self.fallback.chat_stream(messages, complete_callback)
+    except GeneratorExit:
+      raise
+    except Exception as e:
+      raise LmUnavailableError('CPU fallback failed: {}'.format(e)) from e
+
+  def chat_stream(
+    self,
+    messages: list[dict[str, str]],
+    complete_callback: Optional[callable] = None,
+  ):
+    """
+      스트리밍 채팅
+      - 일시적인 오류는 max_retries 만큼 지수 백오프로 재시도하며, 지금까지 받은 답변에 이어서 생성
+      - 서킷 브레이커가 열려 있거나 동시 요청이 max_in_flight 이상이면 CPU fallback으로 답변
+      - 답변을 시작하기 전에 재시도를 모두 실패해도 CPU fallback으로 답변
+      - 답변할 수 없으면 LmUnavailableError 발생
+    """
+    saturated = self.max_in_flight is not None and self.in_flight >= self.max_in_flight
+    if saturated and self._fallback_available():
+      yield from self._fallback_stream(messages, complete_callback)
+      return
+    if not self.circuit_breaker.allow():
+      if self._fallback_available():
+        yield from self._fallback_stream(messages, complete_callback)
+        return
+      raise LmUnavailableError('LM backend circuit is open')
+
+    system_messages = [
+      {"role": "system", "content": self.system_message},
+      *messages
+    ]
+    assistant_message = ""
+    retry_count = 0
+    use_fallback = False
+
+    with self._in_flight_lock:
+      self.in_flight += 1
+    try:
+      while True:
+        try:
+          for content in self._chat_stream_once(system_messages, assistant_message):
+            assistant_message += content
+            yield content
+          self.circuit_breaker.record_success()
+          break
+        except RETRYABLE_ERRORS as e:
+          self.circuit_breaker.record_failure()
+          if retry_count >= self.max_retries or not self.circuit_breaker.allow():
+            if not assistant_message and self._fallback_available():
+              print('🔁 LM backend failed, using CPU fallback: {}'.format(e))
+              use_fallback = True
+              break
+            raise LmUnavailableError('LM backend failed: {}'.format(e)) from e
+          retry_count += 1
+          print('🔁 LM stream failed, retrying... ({} / {}): {}'.format(retry_count, self.max_retries, e))
+          time.sleep(self.retry_backoff * (2 ** (retry_count - 1)) * (0.5 + random.random()))
+        except GeneratorExit:
+          # 소비자가 스트림을 중간에 닫은 경우 - 완료된 응답이 아니므로 시험 요청만 해제
+          self.circuit_breaker.release_probe()
+          raise
+        except Exception:
+          # 재시도 대상이 아닌 오류 (잘못된 요청 등) - 다음 요청을 막지 않도록 시험 요청만 해제
+          self.circuit_breaker.release_probe()
+          raise
+    finally:
+      with self._in_flight_lock:
+        self.in_flight -= 1
+
+    if use_fallback:
+      yield from self._fallback_stream(messages, complete_callback)
+      return
+
+    if complete_callback is not None:
+      complete_callback(assistant_message)
+
+
+
+class ThreadedStream:
+  """
+    동기 스트림(언어모델 chat_stream)을 별도 스레드에서 실행하고 async for로 소비
+    - start()를 호출하면 바로 요청이 시작되므로 초기 메시지 전송 등 다른 작업과 겹쳐서 진행됨
+    - 토큰을 기다리거나 재시도 대기하는 동안 이벤트 루프를 막지 않음
+    - close()를 호출하면 다음 청크를 받을 때 스레드에서 스트림을 닫음
+  """
+  _DONE = object()
+
+  def __init__(self, stream):
+    self._stream = stream
+    self._queue: asyncio.Queue = asyncio.Queue()
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._closed = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+
+  def start(self) -> 'ThreadedStream':
+    if self._thread is None:
+      self._loop = asyncio.get_running_loop()
+      self._thread = threading.Thread(target=self._run, daemon=True)
+      self._thread.start()
+    return self
+
+  def close(self) -> None:
+    self._closed.set()
+
+  def _put(self, item) -> None:
+    try:
+      self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+    except RuntimeError:
+      # 이벤트 루프가 이미 종료됨
+      self._closed.set()
+
+  def _run(self) -> None:
+    error = None
+    try:
+      for chunk in self._stream:
+        if self._closed.is_set():
+          break
+        self._put((chunk, None))
+    except Exception as e:
+      error = e
+    finally:
+      # 중간에 멈춘 경우 제너레이터에 GeneratorExit 전달 (요청 수, 서킷 브레이커 정리)
+      self._stream.close()
+    self._put((self._DONE, error))
+
+  def __aiter__(self):
+    return self
 
-    print('Inference unexpected end')
-    return finish_inference()
+  async def __anext__(self):
+    self.start()
+    chunk, error = await self._queue.get()
+    if chunk is self._DONE:
+      self._closed.set()
+      if error is not None:
+        raise error
+      raise StopAsyncIteration
+    return chunk
@@ -0,0 +1,346 @@
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+
+def download_gguf_model(cache_dir: str = './hf_cache') -> str:
+  from huggingface_hub import hf_hub_download
+  return hf_hub_download(
+    "gphorvath/Ministral-8B-Instruct-2410-Q4_K_M-GGUF",
+    filename="ministral-8b-instruct-2410-q4_k_m.gguf",
+    cache_dir=cache_dir
+  )
+
+def _worker_main(
+  worker_id: int,
+  model_path: str,
+  n_threads: int,
+  n_ctx: int,
+  request_queue: mp.Queue,
+  response_queue: mp.Queue,
+  cancelled,
+):
+  """
+    CPU 추론 워커 프로세스
+    - 모델을 한 번 로드해서 계속 메모리에 유지 (warm)
+    - request_queue에서 요청을 받아 토큰을 response_queue로 스트리밍
+    - cancelled[slot]이 요청 id와 같으면 취소된 요청이므로 시작하지 않거나 토큰 사이에서 중단
+  """
+  try:
+    from llama_cpp import Llama
+    llm = Llama(
+      model_path=model_path,
+      n_ctx=n_ctx,
+      n_threads=n_threads,
+      verbose=False,
+    )
+    # 첫 요청이 느리지 않도록 미리 한 번 실행
+    llm.create_chat_completion(messages=[{'role': 'user', 'content': 'hi'}], max_tokens=1)
+  except Exception as e:
+    response_queue.put((None, 'worker_error', '{}: {}'.format(worker_id, repr(e))))
+    return
+  response_queue.put((None, 'ready', worker_id))
+
+  while True:
+    request = request_queue.get()
+    if request is None:
+      break
+    request_id, slot, messages, params = request
+    if cancelled[slot] == request_id:
+      response_queue.put((request_id, 'cancelled', None))
+      continue
+    try:
+      for chunk in llm.create_chat_completion(messages=messages, stream=True, **params):
+        if cancelled[slot] == request_id:
+          break
+        content = chunk['choices'][0]['delta'].get('content')
+        if content:
+          response_queue.put((request_id, 'chunk', content))
+      response_queue.put((request_id, 'cancelled' if cancelled[slot] == request_id else 'done', None))
+    except Exception as e:
+      response_queue.put((request_id, 'error', repr(e)))
+
+
+
+class VpsbLmCpuServer:
+  """
+    GPU(vllm) 서버 장애/포화 시 사용하는 CPU 전용 언어모델 (GGUF 양자화 모델, llama.cpp)
+    - num_workers개의 프로세스가 각각 모델을 메모리에 유지하고, 동시 요청은 공유 큐에서 나눠서 처리
+      (llama.cpp 파이썬 API는 모델 하나당 한 시퀀스씩 디코딩하므로 동시 처리량은 워커 수로 조절)
+    - CPU 코어는 워커들이 나눠 씀 (n_threads 기본값: 코어 수 / num_workers)
+    - 처리 중이거나 대기 중인 요청은 max_pending개까지만 받음 (기본값: num_workers, 큐에서 오래 기다리지 않도록)
+    - 소비자가 스트림을 닫거나 타임아웃되면 요청을 취소해서 워커가 바로 다음 요청을 처리
+    - chat_stream은 VpsbLmServer2와 같은 형태로 토큰 문자열을 yield
+  """
+  def __init__(
+    self,
+    model_path: Optional[str] = None,
+    num_workers: int = 1,
+    max_pending: Optional[int] = None,
+    n_threads: Optional[int] = None,
+    n_ctx: int = 4096,
+    max_tokens: int = 512,
+    temperature: float = 0.7,
+    read_timeout: float = 120.0,  # 토큰 사이 최대 대기 시간(초), 큐 대기 포함
+  ):
+    self.model_path = model_path or download_gguf_model()
+    self.num_workers = num_workers
+    self.max_pending = max_pending or num_workers
+    self.n_threads = n_threads or max(1, (os.cpu_count() or 1) // num_workers)
+    self.n_ctx = n_ctx
+    self.read_timeout = read_timeout
+    self.params = {
+      'max_tokens': max_tokens,
+      'temperature': temperature,
+    }
+    self.system_message = "You are a professional plastic surgery consultant."
+
+    # fork: 워커가 봇 모듈(__main__)을 다시 import하지 않도록
+    self._ctx = mp.get_context('fork')
+    self.request_queue = self._ctx.Queue()
+    self.response_queue = self._ctx.Queue()
+    self.workers = []
+    self.ready_workers = 0
+    self.failed_workers = 0
+    self._streams: Dict[int, queue.Queue] = {}
+    self._streams_lock = threading.Lock()
+    # 요청마다 슬롯 하나를 사용하고, 취소된 요청 id를 슬롯에 기록해서 워커와 공유
+    self._slots: Dict[int, int] = {}
+    self._free_slots = list(range(self.max_pending))
+    self._cancelled = self._ctx.Array('q', [-1] * self.max_pending, lock=False)
+    self._next_request_id = 0
+    self._dispatcher: Optional[threading.Thread] = None
+
+  def start(self) -> None:
+    if self.workers:
+      return
+    for worker_id in range(self.num_workers):
+      worker = self._ctx.Process(
+        target=_worker_main,
+        args=(worker_id, self.model_path, self.n_threads, self.n_ctx, self.request_queue, self.response_queue, self._cancelled),
+        daemon=True,
+      )
+      worker.start()
+      self.workers.append(worker)
+    self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+    self._dispatcher.start()
+
+  def close(self) -> None:
+    for _ in self.workers:
+      self.request_queue.put(None)
+    for worker in self.workers:
+      worker.join(timeout=5)
+      if worker.is_alive():
+        worker.terminate()
+    self.workers = []
+    if self._dispatcher is not None:
+      self.response_queue.put((None, 'stop', None))
+      self._dispatcher.join(timeout=5)
+      self._dispatcher = None
+
+  def wait_ready(self, timeout: Optional[float] = None) -> bool:
+    # 모든 워커가 모델 로드를 끝낼(또는 실패할) 때까지 기다림, 사용할 수 있는 워커가 있으면 True
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while self.ready_workers + self.failed_workers < self.num_workers:
+      if deadline is not None and time.monotonic() > deadline:
+        return False
+      time.sleep(0.1)
+    return self.ready_workers > 0
+
+  def _dispatch(self) -> None:
+    # 워커 응답을 요청별 큐로 전달
+    while True:
+      request_id, kind, payload = self.response_queue.get()
+      if kind == 'stop':
+        break
+      if kind == 'ready':
+        self.ready_workers += 1
+        continue
+      if kind == 'worker_error':
+        self.failed_workers += 1
+        print('CPU 언어모델 워커 로드 실패: {}'.format(payload))
+        continue
+      with self._streams_lock:
+        slot = self._slots.get(request_id)
+        if slot is None:
+          continue
+        if self._cancelled[slot] == request_id:
+          # 취소된 요청은 워커가 끝냈다고 알려올 때 슬롯을 반환
+          if kind != 'chunk':
+            self._release(request_id)
+          continue
+        self._streams[request_id].put((kind, payload))
+
+  def is_available(self) -> bool:
+    # 모델이 로드된 워커가 하나라도 있는지
+    return self.ready_workers > 0
+
+  def pending_requests(self) -> int:
+    # 워커가 처리 중이거나 큐에서 기다리는 요청 수 (취소됐지만 워커가 아직 끝내지 않은 요청 포함)
+    with self._streams_lock:
+      return len(self._streams)
+
+  def has_capacity(self) -> bool:
+    return self.is_available() and self.pending_requests() < self.max_pending
+
+  def _release(self, request_id: int) -> None:
+    # _streams_lock을 잡은 상태에서 호출
+    self._streams.pop(request_id, None)
+    slot = self._slots.pop(request_id, None)
+    if slot is not None:
+      self._free_slots.append(slot)
+
+  def chat_stream(
+    self,
+    messages: list[dict[str, str]],
+    complete_callback: Optional[callable] = None,
+  ):
+    if not self.is_available():
+      raise RuntimeError('CPU LM workers are not ready')
+    messages = [
+      {"role": "system", "content": self.system_message},
+      *messages
+    ]
+    stream_queue = queue.Queue()
+    with self._streams_lock:
+      if not self._free_slots:
+        raise RuntimeError('CPU LM queue is full ({} pending)'.format(len(self._streams)))
+      request_id = self._next_request_id
+      self._next_request_id += 1
+      slot = self._free_slots.pop()
+      self._cancelled[slot] = -1
+      self._slots[request_id] = slot
+      self._streams[request_id] = stream_queue
+
+    assistant_message = ""
+    finished = False
+    try:
+      self.request_queue.put((request_id, slot, messages, self.params))
+      while True:
+        try:
+          kind, payload = stream_queue.get(timeout=self.read_timeout)
+        except queue.Empty:
+          raise TimeoutError('CPU LM response timeout')
+        if kind == 'chunk':
+          assistant_message += payload
+          yield payload
+        elif kind == 'done':
+          finished = True
+          break
+        else:
+          finished = True
+          raise RuntimeError('CPU LM error: {}'.format(payload))
+    finally:
+      with self._streams_lock:
+        # 스트림이 닫히거나 타임아웃된 경우 - 워커가 이미 끝냈는지 확인
+        while not finished and not stream_queue.empty():
+          finished = stream_queue.get_nowait()[0] != 'chunk'
+        if finished:
+          self._release(request_id)
+        else:
+          # 워커에 취소를 알리고, 워커가 끝냈다고 알려오면 슬롯 반환
+          self._cancelled[slot] = request_id
+
+    if complete_callback is not None:
+      complete_callback(assistant_message)
+
+
+
+def benchmark(
+  server: VpsbLmCpuServer,
+  concurrency: int,
+  num_requests: int,
+) -> Dict[str, Any]:
+  """
+    동시 요청 처리량 측정
+    - 토큰 수는 스트림 청크 수로 근사 (llama.cpp는 토큰마다 청크 하나)
+  """
+  prompts = [
+    "쌍꺼풀 수술 후 붓기는 보통 얼마나 가나요?",
+    "코 성형 상담을 받고 싶은데 어떤 준비가 필요한가요?",
+    "What is the recovery time for rhinoplasty?",
+    "지방흡입 후 운동은 언제부터 할 수 있나요?",
+  ]
+  results = []
+  results_lock = threading.Lock()
+  request_index = iter(range(num_requests))
+  index_lock = threading.Lock()
+
+  def client():
+    while True:
+      with index_lock:
+        index = next(request_index, None)
+      if index is None:
+        return
+      start = time.perf_counter()
+      first_token = None
+      tokens = 0
+      for _ in server.chat_stream([{'role': 'user', 'content': prompts[index % len(prompts)]}]):
+        if first_token is None:
+          first_token = time.perf_counter() - start
+        tokens += 1
+      with results_lock:
+        results.append({
+          'ttft': first_token or 0.0,
+          'latency': time.perf_counter() - start,
+          'tokens': tokens,
+        })
+
+  start = time.perf_counter()
+  threads = [threading.Thread(target=client) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start
+
+  total_tokens = sum(result['tokens'] for result in results)
+  ttfts = sorted(result['ttft'] for result in results)
+  return {
+    'workers': server.num_workers,
+    'threads_per_worker': server.n_threads,
+    'concurrency': concurrency,
+    'requests': len(results),
+    'elapsed': elapsed,
+    'tokens_per_sec': total_tokens / elapsed if elapsed > 0 else 0.0,
+    'requests_per_min': len(results) / elapsed * 60 if elapsed > 0 else 0.0,
+    'ttft_p50': ttfts[len(ttfts) // 2] if ttfts else 0.0,
+    'ttft_max': ttfts[-1] if ttfts else 0.0,
+    'avg_tokens': total_tokens / len(results) if results else 0.0,
+  }
+
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='CPU GGUF fallback LM benchmark')
+  parser.add_argument('--model-path', default=None, help='GGUF file (default: download Ministral-8B Q4_K_M)')
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2])
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--requests', type=int, default=8)
+  parser.add_argument('--max-tokens', type=int, default=128)
+  parser.add_argument('--ready-timeout', type=float, default=600, help='Seconds to wait for the workers to load the model')
+  args = parser.parse_args()
+
+  for num_workers in args.workers:
+    server = VpsbLmCpuServer(
+      model_path=args.model_path,
+      num_workers=num_workers,
+      max_tokens=args.max_tokens,
+    )
+    server.start()
+    if not server.wait_ready(timeout=args.ready_timeout):
+      print('workers={} | model load failed or timed out'.format(num_workers))
+      server.close()
+      continue
+    result = benchmark(server, args.concurrency, args.requests)
+    server.close()
+    print(
+      'workers={workers} threads/worker={threads_per_worker} concurrency={concurrency} requests={requests} | '
+      '{tokens_per_sec:.1f} tok/s, {requests_per_min:.1f} req/min, '
+      'TTFT p50 {ttft_p50:.2f}s max {ttft_max:.2f}s, {avg_tokens:.0f} tok/req, {elapsed:.1f}s total'.format(**result)
+    )
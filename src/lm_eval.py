@@ -0,0 +1,333 @@
+"""
+  언어모델/프롬프트 오프라인 평가
+  - room_chats에서 유저 메시지를 샘플링하고, 그 직전 대화를 기록으로 붙여서 각 백엔드에 다시 요청
+  - 백엔드마다 동시 요청 수를 제한해서 TTFT, 토큰/초, 전체 지연 시간, 출력 길이를 기록
+  - 백엔드마다 시스템 프롬프트 파일을 지정할 수 있어서, 같은 모델에 프롬프트만 바꾼 항목도 한 보고서에서 비교
+  - 결과: output_dir/results.jsonl (요청별), output_dir/report.md (요약 표 + 샘플별 답변 비교)
+
+  사용 예)
+    python lm_eval.py --db chatbot.db --samples 100 --concurrency 8 \\
+      --backend 72b-spec16=http://127.0.0.1:8000/v1,Qwen/Qwen2.5-72B-Instruct-AWQ \\
+      --backend 14b-spec16=http://127.0.0.1:8001/v1,Qwen/Qwen2.5-14B-Instruct-AWQ \\
+      --backend 14b-new-prompt=http://127.0.0.1:8001/v1,Qwen/Qwen2.5-14B-Instruct-AWQ,prompts/new.txt
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+import openai
+
+from db import build_history
+
+
+
+def open_db_readonly(path: str) -> sqlite3.Connection:
+  """
+    평가 중에 봇의 DB를 바꾸지 않도록 읽기 전용으로 열기 (테이블/인덱스 생성도 하지 않음)
+    - room_chats 테이블이 없으면 오류
+  """
+  if not os.path.isfile(path):
+    raise FileNotFoundError('Database not found: {}'.format(path))
+  conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+  conn.row_factory = sqlite3.Row
+  if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='room_chats'").fetchone():
+    conn.close()
+    raise ValueError('No room_chats table in {}'.format(path))
+  return conn
+
+def load_system_prompt(conn: sqlite3.Connection) -> Optional[str]:
+  # 봇 설정(config 테이블, key 0)에 저장된 시스템 프롬프트, 없으면 None
+  if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='config'").fetchone():
+    return None
+  row = conn.execute('SELECT json_data FROM config WHERE key=0').fetchone()
+  if row is None:
+    return None
+  return json.loads(row['json_data']).get('system_prompt')
+
+def sample_conversations(
+  conn: sqlite3.Connection,
+  num_samples: int,
+  history_count: int = 10,
+  seed: int = 0,
+  table_name: str = 'room_chats',
+) -> List[Dict[str, Any]]:
+  """
+    유저 메시지를 무작위로 골라 (직전 대화 기록, 메시지, 당시 답변)을 만듦
+    - 최근 대화(메인 DB)에서만 샘플링, 이미지 메시지('[사진]')는 제외
+    - conn은 row_factory가 sqlite3.Row인 연결 (open_db_readonly)
+  """
+  cursor = conn.cursor()
+  cursor.execute(
+    "SELECT id FROM {} WHERE sender='user' AND message IS NOT NULL AND message != '' AND message NOT LIKE '[사진]%'".format(table_name)
+  )
+  ids = [row[0] for row in cursor.fetchall()]
+  ids = sorted(random.Random(seed).sample(ids, min(num_samples, len(ids))))
+
+  samples = []
+  for message_id in ids:
+    cursor.execute('SELECT * FROM {} WHERE id=?'.format(table_name), (message_id,))
+    row = dict(cursor.fetchone())
+    cursor.execute(
+      'SELECT * FROM {} WHERE user_id=? AND id<? ORDER BY id DESC LIMIT ?'.format(table_name),
+      (row['user_id'], message_id, history_count)
+    )
+    history = [dict(history_row) for history_row in reversed(cursor.fetchall())]
+    # 당시 실제로 보낸 답변 (참고용)
+    cursor.execute(
+      "SELECT message FROM {} WHERE user_id=? AND id>? AND sender='assistant' ORDER BY id LIMIT 1".format(table_name),
+      (row['user_id'], message_id)
+    )
+    reference = cursor.fetchone()
+    samples.append({
+      'id': message_id,
+      'user_id': row['user_id'],
+      'messages': build_history(history) + [{'role': 'user', 'content': row['message']}],
+      'reference': reference[0] if reference else None,
+    })
+  return samples
+
+
+
+async def run_request(
+  client: openai.AsyncOpenAI,
+  model_name: str,
+  messages: List[Dict[str, Any]],
+  max_tokens: int,
+  temperature: float,
+) -> Dict[str, Any]:
+  start = time.perf_counter()
+  ttft = None
+  output = ''
+  chunks = 0
+  completion_tokens = None
+  try:
+    stream = await client.chat.completions.create(
+      model=model_name,
+      messages=messages,
+      temperature=temperature,
+      max_tokens=max_tokens,
+      stream=True,
+      stream_options={'include_usage': True},
+    )
+    async for chunk in stream:
+      if chunk.usage is not None:
+        completion_tokens = chunk.usage.completion_tokens
+      if not chunk.choices:
+        continue
+      content = chunk.choices[0].delta.content
+      if content:
+        if ttft is None:
+          ttft = time.perf_counter() - start
+        output += content
+        chunks += 1
+    error = None
+  except Exception as e:
+    error = repr(e)
+  latency = time.perf_counter() - start
+
+  # usage가 없으면 청크 수로 근사
+  tokens = completion_tokens if completion_tokens is not None else chunks
+  decode_time = latency - (ttft or 0.0)
+  return {
+    'ttft': ttft,
+    'latency': latency,
+    'output_tokens': tokens,
+    'output_chars': len(output),
+    'tokens_per_sec': tokens / decode_time if decode_time > 0 and tokens > 1 else None,
+    'output': output,
+    'error': error,
+  }
+
+async def run_backend(
+  name: str,
+  base_url: str,
+  model_name: str,
+  samples: List[Dict[str, Any]],
+  system_message: str,
+  concurrency: int,
+  max_tokens: int,
+  temperature: float,
+) -> List[Dict[str, Any]]:
+  client = openai.AsyncOpenAI(base_url=base_url, api_key='not-needed', max_retries=0)
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def run_sample(sample):
+    async with semaphore:
+      result = await run_request(
+        client,
+        model_name,
+        [{'role': 'system', 'content': system_message}, *sample['messages']],
+        max_tokens,
+        temperature,
+      )
+    result.update({'backend': name, 'sample_id': sample['id']})
+    return result
+
+  start = time.perf_counter()
+  results = await asyncio.gather(*[run_sample(sample) for sample in samples])
+  elapsed = time.perf_counter() - start
+  print('{}: {} requests in {:.1f}s'.format(name, len(results), elapsed))
+  await client.close()
+  return list(results)
+
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+  values = sorted(value for value in values if value is not None)
+  if not values:
+    return None
+  index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+  return values[index]
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+  ok = [result for result in results if result['error'] is None]
+  tokens_per_sec = [result['tokens_per_sec'] for result in ok if result['tokens_per_sec'] is not None]
+  return {
+    'requests': len(results),
+    'errors': len(results) - len(ok),
+    'ttft_p50': percentile([result['ttft'] for result in ok], 50),
+    'ttft_p90': percentile([result['ttft'] for result in ok], 90),
+    'latency_p50': percentile([result['latency'] for result in ok], 50),
+    'latency_p90': percentile([result['latency'] for result in ok], 90),
+    'tokens_per_sec_mean': sum(tokens_per_sec) / len(tokens_per_sec) if tokens_per_sec else None,
+    'output_tokens_mean': sum(result['output_tokens'] for result in ok) / len(ok) if ok else None,
+  }
+
+def build_report(
+  samples: List[Dict[str, Any]],
+  results_by_backend: Dict[str, List[Dict[str, Any]]],
+  backends: List[Dict[str, str]],
+  concurrency: int,
+  max_sample_outputs: int = 20,
+) -> str:
+  def fmt(value, digits=2):
+    return '-' if value is None else '{:.{}f}'.format(value, digits)
+
+  lines = [
+    '# LM evaluation ({})'.format(time.strftime('%Y-%m-%d %H:%M:%S')),
+    '',
+    'samples: {}, concurrency: {}'.format(len(samples), concurrency),
+    '',
+    '| backend | requests | errors | TTFT p50 (s) | TTFT p90 (s) | latency p50 (s) | latency p90 (s) | tok/s (mean) | output tokens (mean) |',
+    '|---|---|---|---|---|---|---|---|---|',
+  ]
+  for name, results in results_by_backend.items():
+    summary = summarize(results)
+    lines.append('| {} | {} | {} | {} | {} | {} | {} | {} | {} |'.format(
+      name,
+      summary['requests'],
+      summary['errors'],
+      fmt(summary['ttft_p50']),
+      fmt(summary['ttft_p90']),
+      fmt(summary['latency_p50']),
+      fmt(summary['latency_p90']),
+      fmt(summary['tokens_per_sec_mean'], 1),
+      fmt(summary['output_tokens_mean'], 0),
+    ))
+
+  # 백엔드별 모델과 시스템 프롬프트
+  lines += ['', '## Backends', '']
+  for backend in backends:
+    lines.append('- **{}**: {} ({}), system prompt: {}'.format(
+      backend['name'],
+      backend['model_name'],
+      backend['base_url'],
+      backend['prompt_file'] or 'default',
+    ))
+
+  # 샘플별 답변 비교 (품질은 사람이 직접 비교)
+  lines += ['', '## Side-by-side outputs', '']
+  results_by_sample = {}
+  for name, results in results_by_backend.items():
+    for result in results:
+      results_by_sample.setdefault(result['sample_id'], {})[name] = result
+  for sample in samples[:max_sample_outputs]:
+    lines += ['### sample {} (user {})'.format(sample['id'], sample['user_id']), '']
+    lines += ['**user**: ' + sample['messages'][-1]['content'], '']
+    if sample['reference']:
+      lines += ['**reference (sent at the time)**:', '', sample['reference'], '']
+    for name, result in results_by_sample.get(sample['id'], {}).items():
+      lines.append('**{}** (TTFT {}s, {} tokens):'.format(name, fmt(result['ttft']), result['output_tokens']))
+      lines += ['', result['error'] or result['output'], '']
+  return '\n'.join(lines) + '\n'
+
+
+
+def parse_backend(value: str) -> Dict[str, str]:
+  # name=base_url,model[,prompt_file]
+  name, rest = value.split('=', 1)
+  parts = rest.split(',', 2)
+  if len(parts) < 2:
+    raise argparse.ArgumentTypeError('Expected name=base_url,model[,prompt_file]: {}'.format(value))
+  prompt_file = parts[2] if len(parts) > 2 else None
+  system_prompt = None
+  if prompt_file:
+    with open(prompt_file, 'r', encoding='utf-8') as f:
+      system_prompt = f.read().strip()
+  return {
+    'name': name,
+    'base_url': parts[0],
+    'model_name': parts[1],
+    'prompt_file': prompt_file,
+    'system_prompt': system_prompt,
+  }
+
+async def main():
+  parser = argparse.ArgumentParser(description='Replay sampled room_chats against LM backends')
+  parser.add_argument('--db', default='chatbot.db')
+  parser.add_argument('--backend', type=parse_backend, action='append', required=True, help='name=base_url,model[,prompt_file] (repeatable)')
+  parser.add_argument('--samples', type=int, default=50)
+  parser.add_argument('--history', type=int, default=10, help='Number of previous messages to include')
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--max-tokens', type=int, default=1024)
+  parser.add_argument('--temperature', type=float, default=0.7)
+  parser.add_argument('--system-prompt', default=None, help='For backends without prompt_file. Default: system_prompt saved in config')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output-dir', default='eval_results')
+  args = parser.parse_args()
+
+  try:
+    conn = open_db_readonly(args.db)
+  except (FileNotFoundError, ValueError) as e:
+    parser.error(str(e))
+  system_message = args.system_prompt \
+    or load_system_prompt(conn) \
+    or "You are a professional plastic surgery consultant."
+
+  samples = sample_conversations(conn, args.samples, args.history, args.seed)
+  conn.close()
+  print('Sampled {} conversations'.format(len(samples)))
+
+  # 백엔드끼리 서로 영향을 주지 않도록 하나씩 실행
+  results_by_backend = {}
+  for backend in args.backend:
+    results_by_backend[backend['name']] = await run_backend(
+      backend['name'],
+      backend['base_url'],
+      backend['model_name'],
+      samples,
+      backend['system_prompt'] or system_message,
+      args.concurrency,
+      args.max_tokens,
+      args.temperature,
+    )
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  with open(os.path.join(args.output_dir, 'results.jsonl'), 'w', encoding='utf-8') as f:
+    for results in results_by_backend.values():
+      for result in results:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+  report = build_report(samples, results_by_backend, args.backend, args.concurrency)
+  with open(os.path.join(args.output_dir, 'report.md'), 'w', encoding='utf-8') as f:
+    f.write(report)
+  print(report.split('\n## ')[0])
+
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,211 @@
+"""
+  장애 주입용 OpenAI 호환 스트리밍 서버 (VpsbLmServer2 재시도/이어쓰기/서킷 브레이커 확인용)
+  - ok: 정상 스트림
+  - drop: 첫 요청은 두 번째 토큰 전에 연결을 끊음, 이후 요청은 정상 (이어쓰기 확인)
+  - error: 항상 500 응답
+  - hang: 첫 요청은 두 번째 토큰 전에 응답 없이 멈춤, 이후 요청은 정상 (read timeout 확인)
+
+  사용 예)
+    python lm_stub.py            # 시나리오 확인 실행
+    python lm_stub.py --serve --port 8000 --mode drop   # 봇에 직접 연결해서 확인
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+
+
+def _sse_chunk(content: str = None, finish_reason: str = None, role: str = None) -> bytes:
+  delta = {}
+  if role is not None:
+    delta['role'] = role
+  if content is not None:
+    delta['content'] = content
+  data = {
+    'id': 'stub',
+    'object': 'chat.completion.chunk',
+    'created': 0,
+    'model': 'stub',
+    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+  }
+  return 'data: {}\n\n'.format(json.dumps(data)).encode()
+
+class FaultInjectingLmServer:
+  """
+    /v1/chat/completions 스트리밍만 흉내내는 테스트 서버
+    - requests: 받은 요청 본문 목록 (이어쓰기 요청 확인용)
+  """
+  words = ['Hello', ' world', ' again']
+  resumed_words = [' resumed']
+
+  def __init__(self, host: str = '127.0.0.1', port: int = 0, mode: str = 'ok', hang_seconds: float = 2.0):
+    self.mode = mode
+    self.hang_seconds = hang_seconds
+    self.requests: List[Dict[str, Any]] = []
+    stub = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        stub.requests.append(body)
+        stub.handle(self, body, len(stub.requests))
+
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self._thread = None
+
+  @property
+  def base_url(self) -> str:
+    host, port = self.server.server_address[:2]
+    return 'http://{}:{}/v1'.format(host, port)
+
+  def reset(self, mode: str) -> None:
+    self.mode = mode
+    self.requests = []
+
+  def start(self) -> 'FaultInjectingLmServer':
+    self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def close(self) -> None:
+    self.server.shutdown()
+    self.server.server_close()
+
+  def handle(self, handler: BaseHTTPRequestHandler, body: Dict[str, Any], call_index: int) -> None:
+    if self.mode == 'error':
+      handler.send_response(500)
+      handler.send_header('Content-Type', 'application/json')
+      handler.end_headers()
+      handler.wfile.write(b'{"error": {"message": "injected failure"}}')
+      return
+
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/event-stream')
+    handler.end_headers()
+    handler.wfile.write(_sse_chunk(role='assistant', content=''))
+    resumed = body['messages'][-1]['role'] == 'assistant'
+    for index, word in enumerate(self.resumed_words if resumed else self.words):
+      if index == 1 and self.mode == 'drop' and call_index == 1:
+        handler.wfile.flush()
+        handler.connection.shutdown(2)
+        return
+      if index == 1 and self.mode == 'hang' and call_index == 1:
+        time.sleep(self.hang_seconds)
+        return
+      handler.wfile.write(_sse_chunk(content=word))
+      handler.wfile.flush()
+    handler.wfile.write(_sse_chunk(content='', finish_reason='stop'))
+    handler.wfile.write(b'data: [DONE]\n\n')
+
+
+
+def run_checks() -> None:
+  import lm
+
+  stub = FaultInjectingLmServer().start()
+  messages = [{'role': 'user', 'content': 'hi'}]
+
+  def make_server(**kwargs):
+    return lm.VpsbLmServer2(base_url=stub.base_url, model_name='stub', retry_backoff=0.01, **kwargs)
+
+  def check(name, condition):
+    print('{} {}'.format('ok  ' if condition else 'FAIL', name))
+    if not condition:
+      raise AssertionError(name)
+
+  try:
+    stub.reset('ok')
+    check('normal stream', ''.join(make_server().chat_stream(messages)) == 'Hello world again')
+
+    # 연결이 끊기면 받은 답변에 이어서 다시 요청
+    stub.reset('drop')
+    answer = ''.join(make_server().chat_stream(messages))
+    check('resume after dropped stream', answer == 'Hello resumed')
+    check('resume request continues partial answer',
+      len(stub.requests) == 2
+      and stub.requests[1]['messages'][-1] == {'role': 'assistant', 'content': 'Hello'}
+      and stub.requests[1].get('continue_final_message') is True)
+
+    # 재시도를 모두 실패하면 서킷이 열리고, 열린 동안은 요청 없이 바로 실패
+    stub.reset('error')
+    server = make_server(max_retries=2, circuit_breaker=lm.CircuitBreaker(failure_threshold=3, reset_timeout=0.5))
+    try:
+      list(server.chat_stream(messages))
+      check('retries exhausted raises LmUnavailableError', False)
+    except lm.LmUnavailableError:
+      check('retries exhausted raises LmUnavailableError', len(stub.requests) == 3)
+    check('circuit opens after failures', server.circuit_breaker.is_open() and not server.is_available())
+    start = time.monotonic()
+    try:
+      list(server.chat_stream(messages))
+    except lm.LmUnavailableError:
+      pass
+    check('open circuit fails fast', len(stub.requests) == 3 and time.monotonic() - start < 0.1)
+
+    # 시험 요청을 중간에 닫으면 서킷은 닫히지 않고 다음 시험 요청을 허용
+    time.sleep(0.6)
+    stub.reset('ok')
+    stream = server.chat_stream(messages)
+    next(stream)
+    stream.close()
+    check('closed probe keeps circuit half-open', server.circuit_breaker.state == 'half_open' and not server.circuit_breaker.is_open())
+
+    # 시험 요청이 성공하면 다시 닫힘
+    check('half-open probe succeeds', ''.join(server.chat_stream(messages)) == 'Hello world again')
+    check('circuit closes after probe', server.circuit_breaker.state == 'closed')
+
+    # 응답이 멈추면 read timeout 후 이어서 재시도
+    stub.reset('hang')
+    start = time.monotonic()
+    answer = ''.join(make_server(read_timeout=0.3, max_retries=1).chat_stream(messages))
+    check('resume after stalled stream', answer == 'Hello resumed' and 0.3 <= time.monotonic() - start < 1.5)
+
+    # 재시도 대기/read timeout 동안에도 이벤트 루프는 계속 동작 (ThreadedStream)
+    stub.reset('hang')
+    async def consume_with_ticker():
+      ticks = 0
+      async def ticker():
+        nonlocal ticks
+        while True:
+          await asyncio.sleep(0.01)
+          ticks += 1
+      ticker_task = asyncio.create_task(ticker())
+      chunks = [chunk async for chunk in lm.ThreadedStream(make_server(read_timeout=0.3, max_retries=1).chat_stream(messages))]
+      ticker_task.cancel()
+      return ''.join(chunks), ticks
+    answer, ticks = asyncio.run(consume_with_ticker())
+    check('event loop not blocked by stalled stream', answer == 'Hello resumed' and ticks >= 15)
+
+    # 연결 거부
+    server = lm.VpsbLmServer2(base_url='http://127.0.0.1:1/v1', model_name='stub', retry_backoff=0.01)
+    try:
+      list(server.chat_stream(messages))
+      check('connection refused raises LmUnavailableError', False)
+    except lm.LmUnavailableError:
+      check('connection refused raises LmUnavailableError', True)
+  finally:
+    stub.close()
+  print('all checks passed')
+
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Fault-injecting OpenAI-compatible stream server')
+  parser.add_argument('--serve', action='store_true', help='Run the stub server instead of the checks')
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('--mode', choices=['ok', 'drop', 'error', 'hang'], default='ok')
+  args = parser.parse_args()
+
+  if args.serve:
+    stub = FaultInjectingLmServer(port=args.port, mode=args.mode)
+    print('Serving {} (mode: {})'.format(stub.base_url, args.mode))
+    stub.server.serve_forever()
+  else:
+    run_checks()
@@ -3,14 +3,18 @@ import os
 import dotenv
 from telegram.ext import filters, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler
 
-import bot
-
 dotenv.load_dotenv()
 
 if __name__ == '__main__':
+  # 이미지 처리 프로세스 풀(forkserver) 워커는 이 파일을 다시 import하므로 봇 모듈은 여기서 import
+  import bot
+
   application = ApplicationBuilder().token(
     token=os.environ.get('TELEGRAM_BOT_TOKEN')
-  ).build()
+  ).concurrent_updates(
+    # 여러 유저의 메시지를 동시에 처리 (같은 유저의 메시지는 bot.chat_single_private에서 순서대로 처리)
+    int(os.environ.get('CONCURRENT_UPDATES', 64))
+  ).post_init(bot.post_init).post_shutdown(bot.post_shutdown).build()
   
   start_handler = CommandHandler('start', bot.start)
   application.add_handler(start_handler)
@@ -19,6 +23,12 @@ if __name__ == '__main__':
   chat_handler = MessageHandler(filters.ChatType.PRIVATE, bot.chat_single_private)
   application.add_handler(chat_handler)
 
+  search_handler = CommandHandler('search', bot.admin_search, filters=~filters.ChatType.PRIVATE)
+  application.add_handler(search_handler)
+
+  diagnostics_handler = CommandHandler('diag', bot.admin_diagnostics, filters=~filters.ChatType.PRIVATE)
+  application.add_handler(diagnostics_handler)
+
   admin_handler = MessageHandler(~filters.ChatType.PRIVATE, bot.admin_group_chat)
   application.add_handler(admin_handler)
 
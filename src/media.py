@@ -0,0 +1,155 @@
+import asyncio
+import base64
+import io
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import telegram
+
+
+
+def _process_image(data: bytes, max_side: int, quality: int, max_pixels: int) -> bytes:
+  """
+    프로세스 풀에서 실행: 디코딩, 회전 보정, 리사이즈, JPEG 재인코딩
+    - EXIF(위치 정보 등)는 회전에만 사용하고 결과 파일에는 넣지 않음
+  """
+  from PIL import Image, ImageOps
+  Image.MAX_IMAGE_PIXELS = max_pixels
+  with Image.open(io.BytesIO(data)) as image:
+    # MAX_IMAGE_PIXELS는 2배를 넘을 때만 오류를 내므로 디코딩 전에 직접 확인
+    if image.size[0] * image.size[1] > max_pixels:
+      raise Image.DecompressionBombError('Image size ({} pixels) exceeds limit of {} pixels'.format(
+        image.size[0] * image.size[1],
+        max_pixels,
+      ))
+    # JPEG은 디코딩 단계에서 축소해서 메모리 사용량을 줄임
+    image.draft('RGB', (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGB')
+    image.thumbnail((max_side, max_side))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+  return output.getvalue()
+
+def get_image_source(message: telegram.Message, max_side: int = 1024) -> Optional[Tuple[str, str, Optional[int]]]:
+  """
+    메시지의 이미지 첨부 (file_id, file_unique_id, file_size), 없으면 None
+    - 사진은 max_side 이상인 크기 중 가장 작은 것을 선택해서 다운로드 크기를 줄임
+    - 이미지 파일(image/*)로 보낸 문서도 포함
+  """
+  if message.photo:
+    photo = message.photo[-1]
+    for photo_size in sorted(message.photo, key=lambda photo_size: photo_size.width * photo_size.height):
+      if max(photo_size.width, photo_size.height) >= max_side:
+        photo = photo_size
+        break
+    return photo.file_id, photo.file_unique_id, photo.file_size
+  if message.document and (message.document.mime_type or '').startswith('image/'):
+    return message.document.file_id, message.document.file_unique_id, message.document.file_size
+  return None
+
+def to_data_url(jpeg: bytes) -> str:
+  return 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode('ascii')
+
+
+
+class MediaPipeline:
+  """
+    유저가 보낸 이미지를 언어모델 입력으로 변환
+    - 다운로드는 비동기, 디코딩/리사이즈/EXIF 제거는 프로세스 풀에서 처리 (이벤트 루프를 막지 않음)
+    - 처리 결과는 file_unique_id로 캐시 (LRU, cache_max_bytes 이하)
+    - 동시에 다운로드/처리하는 이미지 수를 max_concurrent로 제한해서 메모리 사용량을 제한
+  """
+  def __init__(
+    self,
+    max_workers: int = 2,
+    max_concurrent: int = 4,
+    max_file_size: int = 20 * 1024 * 1024,  # 텔레그램 봇 다운로드 제한
+    max_side: int = 1024,  # 리사이즈 후 긴 변 최대 길이
+    quality: int = 85,
+    max_pixels: int = 50_000_000,  # 디코딩 허용 최대 픽셀 수
+    cache_max_bytes: int = 64 * 1024 * 1024,
+  ):
+    self.max_workers = max_workers
+    self.max_file_size = max_file_size
+    self.max_side = max_side
+    self.quality = quality
+    self.max_pixels = max_pixels
+    self.cache_max_bytes = cache_max_bytes
+    self.cache: OrderedDict = OrderedDict()
+    self.cache_bytes = 0
+    self._semaphore = asyncio.Semaphore(max_concurrent)
+    self._pending: Dict[str, asyncio.Future] = {}
+    self._executor: Optional[ProcessPoolExecutor] = None
+
+  def _get_executor(self) -> ProcessPoolExecutor:
+    if self._executor is None:
+      # forkserver: 스트림/디스패처 스레드가 있는 봇 프로세스를 직접 fork하지 않음 (fork + 스레드는 교착 가능)
+      # - 워커는 __main__을 다시 import하므로 main.py는 봇 모듈을 __main__ 블록 안에서 import함
+      mp_context = mp.get_context('forkserver')
+      mp_context.set_forkserver_preload(['media'])
+      self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp_context)
+    return self._executor
+
+  def close(self) -> None:
+    if self._executor is not None:
+      self._executor.shutdown(wait=False, cancel_futures=True)
+      self._executor = None
+
+  def _cache_put(self, key: str, jpeg: bytes) -> None:
+    if len(jpeg) > self.cache_max_bytes:
+      return
+    self.cache[key] = jpeg
+    self.cache_bytes += len(jpeg)
+    while self.cache_bytes > self.cache_max_bytes:
+      _, old = self.cache.popitem(last=False)
+      self.cache_bytes -= len(old)
+
+  async def get_image(self, bot: telegram.Bot, file_id: str, file_unique_id: str, file_size: Optional[int] = None) -> bytes:
+    # 처리된 JPEG 반환 (캐시 -> 같은 파일 처리 중이면 기다림 -> 다운로드 및 처리)
+    if file_unique_id in self.cache:
+      self.cache.move_to_end(file_unique_id)
+      return self.cache[file_unique_id]
+    if file_unique_id in self._pending:
+      return await asyncio.shield(self._pending[file_unique_id])
+    if file_size is not None and file_size > self.max_file_size:
+      raise ValueError('Image too large ({} bytes)'.format(file_size))
+
+    future = asyncio.get_running_loop().create_future()
+    self._pending[file_unique_id] = future
+    try:
+      async with self._semaphore:
+        telegram_file = await bot.get_file(file_id)
+        data = bytes(await telegram_file.download_as_bytearray())
+        if len(data) > self.max_file_size:
+          raise ValueError('Image too large ({} bytes)'.format(len(data)))
+        jpeg = await asyncio.get_running_loop().run_in_executor(
+          self._get_executor(),
+          _process_image,
+          data,
+          self.max_side,
+          self.quality,
+          self.max_pixels,
+        )
+        del data
+      self._cache_put(file_unique_id, jpeg)
+      future.set_result(jpeg)
+      return jpeg
+    except Exception as e:
+      future.set_exception(e)
+      # 기다리는 쪽이 없을 때 경고가 나오지 않도록
+      future.exception()
+      raise
+    finally:
+      # 취소된 경우(CancelledError)에도 같은 이미지를 기다리는 쪽이 멈추지 않도록 future를 완료
+      if not future.done():
+        future.set_exception(RuntimeError('Image processing cancelled'))
+        future.exception()
+      self._pending.pop(file_unique_id, None)
+
+
+
+# Singletons
+media_pipeline = MediaPipeline()